@@ -0,0 +1,191 @@
+####################
+#   Piki Archive   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+""" Streams whole wikis out as newline-delimited JSON and reads them back in.
+    The first line describes the wiki and every line after it holds one
+    page, in index order:
+        {"title": ..., "publicity": ..., "autosave": ..., "pages": ...}
+        {"title": ..., "content": ...}
+    Revisions and search postings are left out; imported pages start with
+    one revision each and are indexed as they are read.
+        python archive.py export <user slug> <wiki slug> > wiki.ndjson
+        python archive.py import <user slug> < wiki.ndjson
+"""
+
+import sys
+import json
+from datetime import datetime
+from sqlalchemy import bindparam
+import models
+from models import User, Wiki, Page, Block, Revision, Posting, walk_chain, \
+    slugify, sanitize, escape_title, block_pattern
+from search import term_counts
+
+# Pages read or written per query.
+BATCH = 200
+
+
+# # Export # #
+def export_wiki(wiki, batch=BATCH):
+    """ Writes a wiki out a line at a time. Only the order of the pages is
+        loaded at once; their titles and content are read a batch at a
+        time, so memory use does not grow with the size of the wiki.
+    -> wiki; number of pages to read per query
+    <- generator of JSON lines
+    """
+    yield json.dumps({'title': wiki.title, 'publicity': wiki.publicity,
+        'autosave': wiki.autosave, 'pages': wiki.page_count}) + '\n'
+    links = models.session.query(Page.id, Page.next_page_id) \
+        .filter(Page.wiki_id == wiki.id).all()
+    ordered, orphans, cycle = walk_chain(wiki.first_page_id, links)
+    order = [link.id for link in ordered + orphans]
+    del links, ordered, orphans
+    for start in range(0, len(order), batch):
+        page_ids = order[start:start + batch]
+        titles = dict(models.session.query(Page.id, Page.title)
+            .filter(Page.id.in_(page_ids)))
+        blocks = dict((page_id, []) for page_id in page_ids)
+        for page_id, html in models.session.query(Block.page_id, Block.html) \
+                .filter(Block.page_id.in_(page_ids)) \
+                .order_by(Block.page_id, Block.position):
+            blocks[page_id].append(html)
+        for page_id in page_ids:
+            yield json.dumps({'title': titles[page_id],
+                'content': u''.join(blocks[page_id])}) + '\n'
+
+
+# # Import # #
+def import_wiki(author, lines, batch=BATCH):
+    """ Creates a wiki from an exported one. Pages are inserted a batch at a
+        time with set-based statements and nothing is kept of them but the
+        slugs, so memory use does not grow with the size of the wiki. A
+        number is added to the title if it is taken. The caller commits,
+        which makes the whole import one transaction. Publicity is kept
+        within its range, and a public wiki of an unverified author is
+        imported hidden.
+    -> author; iterable of JSON lines, as made by export_wiki()
+    <- new wiki
+    """
+    lines = iter(lines)
+    header = json.loads(next(lines))
+    title = available_title(header['title'])
+    publicity = min(max(int(header.get('publicity', 0)), 0), 2)
+    # Only verified authors may publish, as in the wiki settings.
+    if publicity == 2 and not author.verified:
+        publicity = 1
+    wiki = Wiki(title=title, title_slug=slugify(title), author=author,
+        publicity=publicity, autosave=1 if header.get('autosave', 1) else 0,
+        page_count=0)
+    models.session.flush()
+    slugs = set()
+    entries = []
+    for line in lines:
+        if line.strip():
+            entries.append(json.loads(line))
+        if len(entries) == batch:
+            insert_pages(wiki, entries, slugs)
+            entries = []
+    if entries:
+        insert_pages(wiki, entries, slugs)
+    if not wiki.page_count:
+        raise ValueError("The archive has no pages.")
+    return wiki
+
+
+def available_title(title):
+    """ Finds a title for an imported wiki that no other wiki has.
+    -> wiki title
+    <- the title, or the title with the first free number added to it
+    """
+    candidate = title
+    number = 1
+    while Wiki.query.filter(Wiki.title == candidate).count() or \
+            Wiki.query.filter(Wiki.title_slug == slugify(candidate)).count():
+        number += 1
+        candidate = u'%s (%d)' % (title, number)
+    return candidate
+
+
+def insert_pages(wiki, entries, slugs):
+    """ Inserts a batch of pages with their blocks, first revisions and
+        search postings, and links them to the end of the wiki's index.
+    -> wiki; array of page dictionaries; set of the slugs used so far,
+         which is added to
+    """
+    connection = models.session.connection(Page.mapper)
+    now = datetime.now()
+    page_ids = []
+    blocks, revisions, postings = [], [], []
+    for entry in entries:
+        title, content = entry['title'], sanitize(entry['content'])
+        # The main page is known by having the wiki's title.
+        if wiki.first_page_id is None and not page_ids:
+            if title != wiki.title and content.startswith('<h1>'):
+                content = u'<h1>%s</h1>' % escape_title(wiki.title) + \
+                    content[content.find('</h1>') + 5:]
+            title = wiki.title
+        slug = base = slugify(title)
+        number = 1
+        while slug in slugs:
+            number += 1
+            slug = u'%s-%d' % (base, number)
+        slugs.add(slug)
+        page_id = connection.execute(Page.table.insert(), wiki_id=wiki.id,
+            title=title, title_slug=slug, next_page_id=-1,
+            version=1).inserted_primary_key[0]
+        page_ids.append(page_id)
+        html_blocks = block_pattern.findall(content)
+        blocks.extend({'page_id': page_id, 'position': i, 'html': html}
+            for i, html in enumerate(html_blocks))
+        revisions.append({'page_id': page_id, 'date': now, 'depth': 0,
+            'snapshot': json.dumps(html_blocks)})
+        postings.extend({'term': term, 'page_id': page_id,
+            'wiki_id': wiki.id, 'count': count}
+            for term, count in term_counts(content).iteritems())
+    for table, rows in [(Block.table, blocks), (Revision.table, revisions),
+            (Posting.table, postings)]:
+        if rows:
+            connection.execute(table.insert(), rows)
+    links = zip(page_ids, page_ids[1:])
+    if wiki.last_page_id is None:
+        wiki.first_page_id = page_ids[0]
+    else:
+        links.insert(0, (wiki.last_page_id, page_ids[0]))
+    if links:
+        connection.execute(Page.table.update()
+            .where(Page.table.c.id == bindparam('link_from'))
+            .values(next_page_id=bindparam('link_to')),
+            [{'link_from': a, 'link_to': b} for a, b in links])
+    wiki.last_page_id = page_ids[-1]
+    wiki.page_count += len(page_ids)
+
+
+def main(arguments):
+    usage = "usage: python archive.py export <user slug> <wiki slug>\n" \
+        "       python archive.py import <user slug>"
+    if len(arguments) < 2 or arguments[0] not in ('export', 'import'):
+        sys.exit(usage)
+    models.setup()
+    user = User.get_by(name_slug=arguments[1].decode('utf-8'))
+    if not user:
+        sys.exit("There is no user %s." % arguments[1])
+    if arguments[0] == 'export':
+        if len(arguments) < 3:
+            sys.exit(usage)
+        wiki = user.wiki_by_slug(arguments[2].decode('utf-8'))
+        for line in export_wiki(wiki):
+            sys.stdout.write(line)
+    else:
+        wiki = import_wiki(user, sys.stdin)
+        models.session.commit()
+        print >> sys.stderr, "Imported %s with %d pages." % (wiki.title,
+            wiki.page_count)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
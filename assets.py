@@ -0,0 +1,171 @@
+####################
+#   Piki  Assets   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+""" Builds the static files for production:  python assets.py
+    The CoffeeScript is compiled, the scripts and stylesheets that are always
+    loaded together are joined into bundles and minified, and every file is
+    copied into static/build under a name holding a hash of its content,
+    next to gzip and, if the brotli module is installed, brotli copies. A
+    manifest maps the original names to the built ones. Without a build,
+    the original files are served as they are.
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import shutil
+import subprocess
+from hashlib import sha1
+from flask import url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD = 'build'
+MANIFEST = os.path.join(STATIC, BUILD, 'manifest.json')
+
+# Bundles, by name, and the files joined into them in order.
+BUNDLES = {
+    'css/base.css': ['css/reset.css', 'css/style.css'],
+    'js/editor.js': ['js/lib/rangy-core.js',
+        'js/lib/rangy-selectionsaverestore.js', 'js/lib/rangy-textrange.js',
+        'js/wiki.js'],
+}
+
+
+# # Serving # #
+def load_manifest():
+    """ Reads the names of the built files, if there are any.
+    <- dictionary of built file paths by original name, relative to static
+    """
+    try:
+        with open(MANIFEST) as manifest:
+            return json.load(manifest)
+    except IOError:
+        return {}
+
+manifest = load_manifest()
+
+
+def asset_url(filename):
+    """ Links to a static file, by its built name if it has one.
+    -> file path relative to static
+    <- URL
+    """
+    return url_for('static', filename=manifest.get(filename, filename))
+
+
+def asset_urls(name):
+    """ Links to a bundle, or to the files it is made of if it is not built.
+    -> bundle name or file path relative to static
+    <- array of URLs
+    """
+    if name in manifest or name not in BUNDLES:
+        return [asset_url(name)]
+    return [asset_url(filename) for filename in BUNDLES[name]]
+
+
+# # Building # #
+def minify_css(css):
+    """ Strips comments and whitespace that do not change a stylesheet.
+    -> CSS
+    <- minified CSS
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r' ?([{};,>]) ?', r'\1', css)
+    css = re.sub(r': ', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """ Minifies a script with uglifyjs, or leaves it as it is if uglifyjs
+        is not installed.
+    -> JavaScript
+    <- minified JavaScript
+    """
+    try:
+        uglify = subprocess.Popen(['uglifyjs', '-c', '-m'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+        return js
+    minified, _ = uglify.communicate(js)
+    if uglify.returncode:
+        raise RuntimeError("uglifyjs could not minify a script.")
+    return minified
+
+
+def write_built(filename, content):
+    """ Stores a built file under a name holding a hash of its content, with
+        compressed copies beside it.
+    -> original file path relative to static; file content
+    <- built file path relative to static
+    """
+    root, extension = os.path.splitext(filename)
+    digest = sha1(content).hexdigest()[:10]
+    built = '%s/%s.%s%s' % (BUILD, root, digest, extension)
+    path = os.path.join(STATIC, built)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+    # Set mtime so that unchanged files compress to identical bytes.
+    compressed = gzip.GzipFile(path + '.gz', 'wb', 9, mtime=0)
+    compressed.write(content)
+    compressed.close()
+    if brotli:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+    return built
+
+
+def build():
+    """ Compiles, bundles, minifies, fingerprints and compresses every
+        static file, and writes the manifest.
+    """
+    js_directory = os.path.join(STATIC, 'js')
+    try:
+        subprocess.check_call(['coffee', '-c', js_directory])
+    except OSError:
+        sys.exit("CoffeeScript is needed to compile static/js. "
+            "(npm install -g coffee-script)")
+    shutil.rmtree(os.path.join(STATIC, BUILD), ignore_errors=True)
+    sources = {}
+    for directory, _, filenames in os.walk(STATIC):
+        if os.path.relpath(directory, STATIC).split(os.sep)[0] == BUILD:
+            continue
+        for filename in filenames:
+            if filename.endswith('.coffee'):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, STATIC).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                sources[name] = f.read()
+    for name, filenames in BUNDLES.iteritems():
+        separator = '\n' if name.endswith('.css') else ';\n'
+        sources[name] = separator.join(sources[filename]
+            for filename in filenames)
+    built = {}
+    for name, content in sorted(sources.iteritems()):
+        if name.endswith('.css'):
+            content = minify_css(content)
+        elif name.endswith('.js'):
+            content = minify_js(content)
+        built[name] = write_built(name, content)
+        print "%s -> %s (%d bytes)" % (name, built[name], len(content))
+    with open(MANIFEST, 'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,138 @@
+####################
+#  Piki  Autosave  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import json
+import atexit
+import logging
+from threading import Lock, Timer
+import models
+from models import Autosave
+
+DEFAULT_DELAY = 3.0
+# Times a flush that fails in the background is tried again, each after
+#   twice the delay of the one before.
+RETRIES = 3
+# Pages share this many locks, so that flushes of different pages rarely
+#   wait on each other.
+LOCK_STRIPES = 64
+
+log = logging.getLogger('piki.autosave')
+log.addHandler(logging.NullHandler())
+
+
+class WriteBehind(object):
+    """ Queues the content patches sent for each page in the database and
+        applies them all in one go a short while after the first one
+        arrives, so that autosaves made while typing share a single
+        transaction. A patch is stored before its save is answered, and the
+        queue is shared by every process: whichever one next needs the page
+        applies its patches, in the order they were stored. Pending patches
+        are applied early when something needs the page, and at exit.
+    """
+    def __init__(self, apply, delay=DEFAULT_DELAY, teardown=None):
+        """ -> function applying a page's queued patches by page id and
+                 committing, returning whether there were any and raising
+                 if it fails; seconds to wait before applying, 0 to apply
+                 every patch as it is saved; function to call after
+                 patches are applied in the background
+        """
+        self.apply = apply
+        self.delay = delay
+        self.teardown = teardown
+        self.timers = {}
+        self.lock = Lock()
+        self.page_locks = [Lock() for i in range(LOCK_STRIPES)]
+        self.flushes = 0
+        self.failures = 0
+        self.last_failure = None
+        atexit.register(self.flush_all)
+
+    def add(self, page_id, patch):
+        """ Stores a patch for a page and schedules it to be applied.
+        -> page id; array of changed content blocks
+        """
+        Autosave(page_id=page_id, patch=json.dumps(patch))
+        models.session.commit()
+        if not self.delay:
+            self.flush(page_id)
+            return
+        self.schedule(page_id, self.delay, 0)
+
+    def schedule(self, page_id, delay, retry):
+        with self.lock:
+            if page_id in self.timers:
+                return
+            timer = Timer(delay, self.flush_later, [page_id, retry])
+            timer.daemon = True
+            self.timers[page_id] = timer
+            timer.start()
+
+    def flush(self, page_id):
+        """ Applies a page's queued patches, if it has any.
+        -> page id
+        """
+        with self.page_locks[page_id % LOCK_STRIPES]:
+            with self.lock:
+                timer = self.timers.pop(page_id, None)
+            if timer:
+                timer.cancel()
+            if self.apply(page_id):
+                with self.lock:
+                    self.flushes += 1
+
+    def try_flush(self, page_id):
+        """ Applies a page's queued patches for a request that only reads
+            it, which goes on with the page as it was if they fail.
+        -> page id
+        <- whether the patches were applied
+        """
+        try:
+            self.flush(page_id)
+        except Exception:
+            self.failed(page_id)
+            models.session.rollback()
+            return False
+        return True
+
+    def flush_later(self, page_id, retry):
+        try:
+            self.flush(page_id)
+        except Exception:
+            self.failed(page_id)
+            models.session.rollback()
+            if retry < RETRIES:
+                self.schedule(page_id, self.delay * 2 ** (retry + 1),
+                    retry + 1)
+        finally:
+            if self.teardown:
+                self.teardown()
+
+    def failed(self, page_id):
+        with self.lock:
+            self.failures += 1
+            self.last_failure = 'page %d' % page_id
+        log.exception("Applying the autosaves of page %d failed.", page_id)
+
+    def flush_all(self):
+        """ Applies the patches this process has scheduled, and waits for
+            the flushes already under way.
+        """
+        for page_id in list(self.timers):
+            self.try_flush(page_id)
+        for lock in self.page_locks:
+            with lock:
+                pass
+
+    def stats(self):
+        """ Reports the state of the queue for monitoring.
+        <- dictionary of patches waiting in the database, flushes and failed
+             flushes since start, and the page of the latest failure
+        """
+        return {'queued': Autosave.query.count(), 'flushes': self.flushes,
+            'failures': self.failures, 'last_failure': self.last_failure}
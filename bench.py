@@ -0,0 +1,738 @@
+####################
+#  Piki Benchmark  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+""" Measures the hot endpoints on a throwaway database filled with made-up
+    users, wikis and pages:  python bench.py > results.json
+    Requests are made through the Flask test client, then over HTTP by
+    several workers at once against a threaded server started here, or
+    against a running server with --url. The results are printed as JSON, so
+    that runs on two commits can be compared. The same --seed always makes
+    the same data and requests. How long a fresh process takes to import
+    the server and to ready it is measured as well, as every worker pays for
+    it when it starts.
+    Other suites measure one piece at a time:  python bench.py <suite>
+        sanitize - the sanitizer against the reversing one it replaced
+        login - password checks per second by hashing pool size
+        writes - pages created per second by concurrent server processes
+        sidebar - page rendering time and memory by number of pages in the
+            wiki
+        search - search latency over a corpus of --corpus pages
+        typing - autosaves per second from writers typing at once
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import logging
+import subprocess
+import cookielib
+import urllib
+import urllib2
+from contextlib import contextmanager
+from multiprocessing import Process, Queue, cpu_count
+from threading import Thread
+
+SCENARIOS = ['wiki_page', 'save', 'save_title', 'save_flushed',
+    'update_index', 'read', 'login']
+# Title-changing saves of one wiki must arrive in order, so they are sent by
+#   a single HTTP worker.
+ORDERED_SCENARIOS = ['save_title']
+# Each wiki has a page whose title the save_title scenario toggles.
+SCRATCH_TITLES = [u'Scratch', u'Scratch pad']
+PASSWORD = u'benchmark'
+
+queries_pattern = re.compile(r'db;desc="(\d+) queries"')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('suite', nargs='?', default='endpoints',
+        choices=sorted(SUITES))
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--wikis', type=int, default=2,
+        help="wikis per user")
+    parser.add_argument('--pages', type=int, default=50,
+        help="pages per wiki")
+    parser.add_argument('--blocks', type=int, default=10,
+        help="paragraphs per page")
+    parser.add_argument('--corpus', type=int, default=100000,
+        help="pages to search in the search suite")
+    parser.add_argument('--requests', type=int, default=200,
+        help="requests per scenario")
+    parser.add_argument('--workers', type=int, default=4,
+        help="concurrent HTTP workers; 0 to skip the HTTP run")
+    parser.add_argument('--url', help="server to load over HTTP instead of "
+        "starting one; it must use the same database")
+    parser.add_argument('--database', help="database URL; a temporary "
+        "SQLite database if not given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-startup', type=float, metavar='MS',
+        help="exit with an error if a fresh process takes longer than this "
+        "to import and ready the server; endpoints suite only")
+    options = parser.parse_args()
+    if options.max_startup and options.suite != 'endpoints':
+        parser.error("--max-startup only applies to the endpoints suite, "
+            "which measures startup")
+    return options
+
+
+# # Data # #
+def words(rng, count):
+    vocabulary = ['wiki', 'page', 'note', 'idea', 'garden', 'river', 'piano',
+        'coffee', 'paper', 'window', 'letter', 'engine', 'forest', 'market']
+    return ' '.join(rng.choice(vocabulary) for i in range(count))
+
+
+def slugify(title):
+    return title.lower().replace(' ', '-')
+
+
+def populate(options, rng):
+    """ Fills the database with users, each with published wikis of chained
+        pages with revisions and search postings.
+    <- array of (user slug, wiki slug, array of page titles) tuples
+    """
+    import models
+    import search
+    import passwords
+    from models import User, Wiki, Page
+    models.setup(options.database)
+    models.create_all()
+    wikis = []
+    for u in range(options.users):
+        name = u'user%d' % u
+        user = User(name=name, name_slug=name, email=u'%s@example.com' % name,
+            password=passwords.hash_password(PASSWORD), verified=True)
+        for w in range(options.wikis):
+            title = u'Wiki %d of %s' % (w, name)
+            slug = slugify(title)
+            wiki = Wiki(title=title, title_slug=slug, author=user,
+                publicity=2)
+            titles = []
+            for p in range(options.pages + 1):
+                if p == options.pages:
+                    page_title = SCRATCH_TITLES[0]
+                else:
+                    page_title = title if p == 0 else u'Page %d' % p
+                content = u'<h1>%s</h1>' % page_title + u''.join(
+                    u'<p>%s</p>' % words(rng, 40)
+                    for b in range(options.blocks))
+                page = Page(wiki=wiki, title=page_title,
+                    title_slug=slugify(page_title),
+                    content=content)
+                page.record_revision()
+                search.index_page(page)
+                models.session.flush()
+                wiki.append_page(page)
+                titles.append(page_title)
+            wikis.append((name, slug, titles[:-1]))
+        models.session.commit()
+    models.session.remove()
+    return wikis
+
+
+def archive_lines(rng, title, pages, blocks, vocabulary=None):
+    """ Makes up a wiki in the format archive.py reads, to load large wikis
+        quickly.
+    -> random generator; wiki title; number of pages; paragraphs per page;
+         function drawing a number of words, words() if not given
+    <- generator of JSON lines
+    """
+    draw = vocabulary or (lambda count: words(rng, count))
+    yield json.dumps({'title': title, 'publicity': 2, 'autosave': 1,
+        'pages': pages})
+    for p in range(pages):
+        page_title = title if p == 0 else u'Page %d' % p
+        yield json.dumps({'title': page_title,
+            'content': u'<h1>%s</h1>' % page_title + u''.join(
+            u'<p>%s</p>' % draw(40) for b in range(blocks))})
+
+
+def make_author(name):
+    """ Adds a verified user to own imported wikis.
+    <- user
+    """
+    import passwords
+    from models import User
+    return User(name=name, name_slug=name, email=u'%s@example.com' % name,
+        password=passwords.hash_password(PASSWORD), verified=True)
+
+
+def make_requests(options, rng, wikis):
+    """ Draws the requests of every scenario up front, so that both runs
+        make the same ones. Title-changing saves come in pairs that rename a
+        wiki's scratch page and name it back, so that every run finds it.
+    <- dictionary of arrays of (user slug, method, path, form) by scenario
+    """
+    planned = dict((scenario, []) for scenario in SCENARIOS)
+    for i in range(options.requests):
+        user, wiki, titles = rng.choice(wikis)
+        title = rng.choice(titles)
+        slug = slugify(title)
+        planned['wiki_page'].append((user, 'GET',
+            '/:%s/%s/%s' % (user, wiki, slug), None))
+        # An edited paragraph, the way the editor sends it.
+        patch = ['undefined'] * (options.blocks + 1)
+        patch[rng.randrange(1, options.blocks + 1)] = \
+            '<p>%s</p>' % words(rng, 40)
+        planned['save'].append((user, 'POST',
+            '/:%s/%s/%s/save!' % (user, wiki, slug), {'patch': patch}))
+        planned['save_flushed'].append((user, 'POST',
+            '/:%s/%s/%s/save!' % (user, wiki, slug), {'patch': patch}))
+        for old, new in [SCRATCH_TITLES, SCRATCH_TITLES[::-1]]:
+            planned['save_title'].append((user, 'POST',
+                '/:%s/%s/%s/save!' % (user, wiki, slugify(old)),
+                {'patch': ['<h1>%s</h1>' % new]}))
+        moved, after = rng.sample(titles[1:], 2)
+        planned['update_index'].append((user, 'POST',
+            '/:%s/%s/update-index!' % (user, wiki),
+            {'page': moved, 'new_preceding': after}))
+        planned['read'].append((None, 'GET', '/read', None))
+        planned['login'].append((user, 'POST', '/login',
+            {'name': user, 'password': PASSWORD}))
+    return planned
+
+
+# # Measuring # #
+def summarize(samples, elapsed):
+    """ Sums up the requests of a scenario.
+    -> array of (seconds, status, number of queries or None); seconds the
+         whole scenario took
+    <- dictionary of throughput, latency percentiles, statuses and mean
+         queries per request
+    """
+    latencies = sorted(sample[0] for sample in samples)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+    queries = [sample[2] for sample in samples if sample[2] is not None]
+    def percentile(fraction):
+        index = min(int(fraction * len(latencies)), len(latencies) - 1)
+        return round(latencies[index] * 1000, 2)
+    return {
+        'requests': len(samples),
+        'per_second': round(len(samples) / elapsed, 1),
+        'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'statuses': statuses,
+        'queries': round(float(sum(queries)) / len(queries), 2)
+            if queries else None,
+    }
+
+
+@contextmanager
+def autosave_delay(scenario):
+    """ Applies the saves of the save_flushed scenario as they arrive, and
+        lets the others wait to be applied together as usual. Saves left
+        by the scenario before are applied first, so that they do not
+        conflict with this one's writes.
+    """
+    import piki
+    piki.autosaves.flush_all()
+    delay = piki.autosaves.delay
+    if scenario == 'save_flushed':
+        piki.autosaves.delay = 0
+    try:
+        yield
+    finally:
+        piki.autosaves.delay = delay
+
+
+def count_queries(headers):
+    match = queries_pattern.search(headers.get('Server-Timing') or '')
+    return int(match.group(1)) if match else None
+
+
+def run_client(app, planned):
+    """ Makes every request one after another through the test client.
+    <- dictionary of summaries by scenario
+    """
+    clients = {}
+    def client(user):
+        if user not in clients:
+            clients[user] = app.test_client()
+            if user:
+                clients[user].post('/login',
+                    data={'name': user, 'password': PASSWORD})
+        return clients[user]
+    results = {}
+    for scenario in SCENARIOS:
+        samples = []
+        began = time.time()
+        with autosave_delay(scenario):
+            for user, method, path, form in planned[scenario]:
+                start = time.time()
+                response = client(user).open(path, method=method, data=form)
+                samples.append((time.time() - start, response.status_code,
+                    count_queries(response.headers)))
+        results[scenario] = summarize(samples, time.time() - began)
+    return results
+
+
+class NoRedirects(urllib2.HTTPRedirectHandler):
+    """ Leaves redirects unfollowed, so that each request is timed alone. """
+    def redirect_request(self, *args):
+        return None
+
+
+def run_http(url, planned, workers):
+    """ Makes the requests of each scenario over HTTP, shared out among
+        concurrent workers that each keep their own login cookies. The
+        save_flushed scenario applies saves as they arrive only on the
+        server started here.
+    <- dictionary of summaries by scenario
+    """
+    results = {}
+    for scenario in SCENARIOS:
+        requests = list(planned[scenario])
+        if scenario in ORDERED_SCENARIOS:
+            wikis = sorted(set(path.split('/')[2] for user, method, path,
+                form in requests))
+            shares = [[request for request in requests
+                if wikis.index(request[2].split('/')[2]) % workers == i]
+                for i in range(workers)]
+        else:
+            shares = [requests[i::workers] for i in range(workers)]
+        samples = []
+        def work(share):
+            openers = {}
+            for user, method, path, form in share:
+                if user not in openers:
+                    openers[user] = urllib2.build_opener(NoRedirects,
+                        urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+                    if user:
+                        try:
+                            openers[user].open(url + '/login',
+                                urllib.urlencode({'name': user,
+                                'password': PASSWORD}))
+                        except urllib2.HTTPError:
+                            pass
+                data = urllib.urlencode(form, True) if form else None
+                start = time.time()
+                try:
+                    response = openers[user].open(url + urllib.quote(path),
+                        data)
+                    response.read()
+                    status, headers = response.getcode(), response.info()
+                except urllib2.HTTPError as error:
+                    status, headers = error.code, error.info()
+                samples.append((time.time() - start, status,
+                    count_queries(headers)))
+        threads = [Thread(target=work, args=(share,)) for share in shares]
+        began = time.time()
+        with autosave_delay(scenario):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        results[scenario] = summarize(samples, time.time() - began)
+    return results
+
+
+def startup(database, runs=5):
+    """ Times cold starts: each run imports the server in a new process and
+        readies it, without serving anything.
+    -> database URL; number of processes to start
+    <- dictionary of median import, create_app() and total milliseconds
+    """
+    script = ("import sys, time; start = time.time(); import piki; "
+        "imported = time.time(); piki.create_app(sys.argv[1]); "
+        "print imported - start, time.time() - imported")
+    samples = []
+    for run in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script,
+            database], cwd=os.path.dirname(os.path.abspath(__file__)))
+        samples.append([float(value) for value in output.split()])
+    def median(values):
+        return round(sorted(values)[len(values) // 2] * 1000, 1)
+    return {'import_ms': median([sample[0] for sample in samples]),
+        'create_app_ms': median([sample[1] for sample in samples]),
+        'total_ms': median([sum(sample) for sample in samples])}
+
+
+def serve(app):
+    """ Starts a threaded server for the app on a free local port.
+    <- server URL
+    """
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# # Suites # #
+def endpoints(options):
+    """ Measures the hot endpoints; see the top of this file. """
+    rng = random.Random(options.seed)
+    began = time.time()
+    wikis = populate(options, rng)
+    populated = time.time() - began
+    planned = make_requests(options, rng, wikis)
+    started = startup(options.database)
+    import piki
+    results = {'client': run_client(piki.create_app(options.database),
+        planned)}
+    piki.autosaves.flush_all()
+    if options.workers:
+        url = options.url or serve(piki.app)
+        results['http'] = run_http(url, planned, options.workers)
+        piki.autosaves.flush_all()
+    return {'populate_seconds': round(populated, 2), 'startup': started,
+        'results': results}
+
+
+def best_time(function, *args):
+    """ Times a function by its fastest run, repeating it for at least a
+        fifth of a second.
+    <- milliseconds
+    """
+    times = []
+    while sum(times) < 0.2 or len(times) < 3:
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return round(min(times) * 1000, 3)
+
+
+def sanitize(options):
+    """ Times the sanitizer on pages of growing size against the one it
+        replaced, which reversed the whole page to look behind. Both make
+        two substitution passes. Pages are plain text with allowed tags, or
+        full of brackets to escape.
+    """
+    from models import sanitize
+    from tests.test_sanitize import reference_sanitize
+    rng = random.Random(options.seed)
+    blocks = {
+        'plain': u''.join(u'<p>%s <b>%s</b> %s</p>' % (words(rng, 30),
+            words(rng, 2), words(rng, 20)) for i in range(8)),
+        'brackets': u''.join(u'<p>%s <b>%s</b> 1 < 2 <script>%s</script>'
+            u'</p>' % (words(rng, 10), words(rng, 2), words(rng, 2))
+            for i in range(8))}
+    results = {}
+    for kind, block in blocks.iteritems():
+        for kilobytes in [1, 10, 100, 1000, 5000]:
+            html = (block * (kilobytes * 1024 // len(block) + 1))[
+                :kilobytes * 1024]
+            results['%s_%d_kb' % (kind, kilobytes)] = {
+                'old_ms': best_time(reference_sanitize, html),
+                'new_ms': best_time(sanitize, html)}
+    return {'results': results}
+
+
+def login(options):
+    """ Checks passwords from eight threads at once through hashing pools of
+        growing size, the way login does.
+    """
+    import passwords
+    pwhash = passwords.hash_password(PASSWORD)
+    results = {}
+    for workers in [1, 2, 4]:
+        hasher = passwords.Hasher(workers=workers)
+        hasher.start()
+        outcomes = []
+        def check():
+            for i in range(options.requests // 8):
+                try:
+                    outcomes.append(hasher.check(pwhash, PASSWORD))
+                except passwords.Saturated:
+                    outcomes.append(None)
+        threads = [Thread(target=check) for i in range(8)]
+        began = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - began
+        hasher.pool.terminate()
+        checked = len([outcome for outcome in outcomes if outcome])
+        results['%d_workers' % workers] = {'checked': checked,
+            'shed': outcomes.count(None),
+            'per_second': round(checked / elapsed, 1)}
+    return {'cpus': cpu_count(), 'results': results}
+
+
+def create_pages(database, user, wiki, count, results):
+    """ Creates pages through save! in a server process of its own.
+    -> database URL; user slug; wiki slug; number of pages; queue to put
+         the statuses of the saves on
+    """
+    import piki
+    app = piki.create_app(database)
+    client = app.test_client()
+    client.post('/login', data={'name': user, 'password': PASSWORD})
+    statuses = []
+    for i in range(count):
+        title = u'Created by %d number %d' % (os.getpid(), i)
+        response = client.post('/:%s/%s/%s/save!' % (user, wiki,
+            slugify(title)), data={'patch': ['<h1>%s</h1>' % title,
+            '<p>%s</p>' % title]})
+        statuses.append(response.status_code)
+    results.put(statuses)
+
+
+def writes(options):
+    """ Creates pages from growing numbers of server processes at once,
+        each writing to its own wiki while there are enough of them.
+    """
+    wikis = populate(options, random.Random(options.seed))
+    results = {}
+    for processes in [1, 4, 8]:
+        statuses = Queue()
+        workers = [Process(target=create_pages, args=(options.database,
+            wikis[i % len(wikis)][0], wikis[i % len(wikis)][1], 40,
+            statuses)) for i in range(processes)]
+        began = time.time()
+        for worker in workers:
+            worker.start()
+        counts = {}
+        for worker in workers:
+            for status in statuses.get():
+                counts[str(status)] = counts.get(str(status), 0) + 1
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - began
+        results['%d_processes' % processes] = {'statuses': counts,
+            'per_second': round(counts.get('200', 0) / elapsed, 1)}
+    return {'results': results}
+
+
+def sidebar(options):
+    """ Renders a page of wikis of growing size through a page cache that
+        keeps nothing, so that the page and its sidebar index are rendered
+        afresh every time. The peak memory of rendering is measured as well,
+        in a new process for each size of wiki, as the peak only grows.
+    """
+    # Processes start with the peak of the one that started them, so they
+    #   are started before this one has grown.
+    memory_sizes = [50, 100, 200]
+    probes = [memory_probe(options.database) for pages in memory_sizes]
+    import piki
+    import models
+    import archive
+    from cache import PageCache, LRUBackend
+    app = piki.create_app(options.database)
+    piki.page_cache = PageCache(LRUBackend(max_entries=0))
+    models.create_all()
+    rng = random.Random(options.seed)
+    author = make_author(u'sidebar')
+    sizes = [50, 100, 200, 400, 800, 1600]
+    wikis = []
+    for pages in sizes:
+        wiki = archive.import_wiki(author, archive_lines(rng,
+            u'Sidebar %d' % pages, pages, 2))
+        wikis.append(wiki.title_slug)
+    # Pages of about 100 KB each, to show that the index loads none of them.
+    large_wikis = []
+    for pages in memory_sizes:
+        wiki = archive.import_wiki(author, archive_lines(rng,
+            u'Large %d' % pages, pages, 400))
+        large_wikis.append(wiki.title_slug)
+    models.session.commit()
+    models.session.remove()
+    client = app.test_client()
+    results = {}
+    for pages, slug in zip(sizes, wikis):
+        samples = []
+        began = time.time()
+        for i in range(options.requests // 4):
+            start = time.time()
+            response = client.get('/:sidebar/%s/page-%d' % (slug,
+                rng.randrange(1, pages)))
+            samples.append((time.time() - start, response.status_code,
+                count_queries(response.headers)))
+        results['%d_pages' % pages] = summarize(samples,
+            time.time() - began)
+    memory = {}
+    for pages, slug, probe in zip(memory_sizes, large_wikis, probes):
+        memory['%d_large_pages' % pages] = peak_memory(probe,
+            ['/:sidebar/%s/page-%d' % (slug, p) for p in [1, 2, 3]])
+    return {'results': results, 'memory': memory}
+
+
+def memory_probe(database):
+    """ Starts a process that waits for a line of page paths on its input,
+        then readies the server and renders them through a page cache that
+        keeps nothing, reading its peak resident memory before and after.
+    -> database URL
+    <- the process
+    """
+    script = ("import sys, resource; paths = sys.stdin.readline().split(); "
+        "import piki, cache; app = piki.create_app(sys.argv[1]); "
+        "piki.page_cache = cache.PageCache(cache.LRUBackend(0)); "
+        "client = app.test_client(); "
+        "peak = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss; "
+        "ready = peak(); "
+        "statuses = [client.get(path).status_code for path in paths]; "
+        "print ready, peak(), all(status == 200 for status in statuses)")
+    return subprocess.Popen([sys.executable, '-c', script, database],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_memory(probe, paths):
+    """ Has a process started by memory_probe() render pages.
+    -> the process; paths of the pages
+    <- dictionary of peak kilobytes once the server is ready, once the pages
+         are rendered, and their difference
+    """
+    output = probe.communicate(' '.join(paths) + '\n')[0]
+    ready, rendered, succeeded = output.split()
+    if succeeded != 'True':
+        raise RuntimeError("Rendering %s failed." % ', '.join(paths))
+    return {'ready_kb': int(ready), 'rendered_kb': int(rendered),
+        'rendering_kb': int(rendered) - int(ready)}
+
+
+def search_corpus(options):
+    """ Searches a large corpus of published pages by a handful of words,
+        both directly and through /search, both across every wiki and in
+        one. Words are drawn from a large vocabulary, a few of them far more
+        often than the rest, as in real text.
+    """
+    import piki
+    import models
+    import search
+    import archive
+    app = piki.create_app(options.database)
+    models.create_all()
+    rng = random.Random(options.seed)
+    vocabulary = [u''.join(rng.choice('bcdfgklmnprstvz') + rng.choice('aeiou')
+        for i in range(rng.randint(2, 4))) for j in range(5000)]
+    def draw(count):
+        return u' '.join(vocabulary[int(len(vocabulary) * rng.random() ** 3)]
+            for i in range(count))
+    author = make_author(u'search')
+    wikis = 10
+    began = time.time()
+    for w in range(wikis):
+        archive.import_wiki(author, archive_lines(rng, u'Corpus %d' % w,
+            options.corpus // wikis, 2, draw))
+        models.session.commit()
+    populated = time.time() - began
+    wiki = models.Wiki.get_by(title=u'Corpus 0')
+    queries = [draw(rng.randint(1, 3)) for i in range(options.requests)]
+    results = {}
+    for scope, target in [('all_wikis', None), ('one_wiki', wiki)]:
+        samples = []
+        began = time.time()
+        for query in queries:
+            start = time.time()
+            search.search(query, wiki=target)
+            samples.append((time.time() - start, 200, None))
+        results['search_%s' % scope] = summarize(samples,
+            time.time() - began)
+    models.session.remove()
+    client = app.test_client()
+    samples = []
+    began = time.time()
+    for query in queries:
+        start = time.time()
+        response = client.get('/search', query_string={'q': query})
+        samples.append((time.time() - start, response.status_code,
+            count_queries(response.headers)))
+    results['http_search'] = summarize(samples, time.time() - began)
+    return {'populate_seconds': round(populated, 2), 'results': results}
+
+
+def typing(options):
+    """ Has growing numbers of writers type into pages of their own at once,
+        each saving after every word as autosave does, and counts how many
+        flushes applied the saves.
+    """
+    import piki
+    import models
+    app = piki.create_app(options.database)
+    wikis = populate(options, random.Random(options.seed))
+    results = {}
+    for writers in [1, 4, 8]:
+        flushes = piki.autosaves.flushes
+        statuses = []
+        def type_into(i):
+            user, wiki, titles = wikis[i % len(wikis)]
+            client = app.test_client()
+            client.post('/login', data={'name': user, 'password': PASSWORD})
+            path = '/:%s/%s/%s/save!' % (user, wiki, slugify(
+                titles[1 + i // len(wikis)]))
+            text = u''
+            try:
+                for word in range(options.requests // 4):
+                    text += u' w%d' % word
+                    patch = ['undefined'] * (options.blocks + 1)
+                    patch[1] = u'<p>%s</p>' % text
+                    statuses.append(client.post(path, data={'patch': patch,
+                        'sequence': str(word + 1)}).status_code)
+            finally:
+                models.session.remove()
+        threads = [Thread(target=type_into, args=[i])
+            for i in range(writers)]
+        began = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - began
+        piki.autosaves.flush_all()
+        counts = {}
+        for status in statuses:
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        results['%d_writers' % writers] = {'statuses': counts,
+            'per_second': round(len(statuses) / elapsed, 1),
+            'flushes': piki.autosaves.flushes - flushes}
+    return {'results': results}
+
+
+SUITES = {'endpoints': endpoints, 'sanitize': sanitize, 'login': login,
+    'writes': writes, 'sidebar': sidebar, 'search': search_corpus,
+    'typing': typing}
+
+
+def main():
+    options = parse_args()
+    directory = None
+    if not options.database:
+        directory = tempfile.mkdtemp(prefix='piki-bench-')
+        options.database = 'sqlite:///%s' % os.path.join(directory,
+            'bench.sqlite')
+    try:
+        report = SUITES[options.suite](options)
+        config = dict(vars(options))
+        config.pop('url')
+        # Only the kind of database, as the URL may hold a password.
+        config['database'] = options.database.split(':')[0]
+        report.update(commit=commit(), config=config)
+        print json.dumps(report, indent=2, sort_keys=True)
+        if options.max_startup and \
+                report['startup']['total_ms'] > options.max_startup:
+            sys.exit("Starting took %.1f ms, over the %.1f ms allowed." % (
+                report['startup']['total_ms'], options.max_startup))
+    finally:
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+####################
+#    Piki Cache    #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+DEFAULT_SIZE = 500
+
+
+class LRUBackend(object):
+    """ Keeps cached values in process memory, discarding the least recently
+        used one once more than max_entries are stored.
+    """
+    def __init__(self, max_entries=DEFAULT_SIZE):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedBackend(object):
+    """ Wraps a werkzeug.contrib.cache client (eg MemcachedCache) so that
+        every server process shares one cache. Evictions happen inside the
+        cache server and are not counted here.
+    """
+    evictions = None
+
+    def __init__(self, client, timeout=0):
+        self.client = client
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class PageCache(object):
+    """ Caches rendered wiki pages by wiki id, page id, viewer role and the
+        version of the wiki, which every write to it increments in whichever
+        process makes it. Keys built from an old version are simply never
+        asked for again and age out of the backend.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, wiki_id, page_id, role, version, verified):
+        """ Builds the cache key of a rendered page. Take the version from
+            the wiki as it was loaded before anything the page is rendered
+            from, so that a page rendered while its wiki is being changed is
+            stored under the outdated version and never served.
+        -> wiki id; page id; viewer role; wiki version; whether the author
+             is verified
+        <- cache key string
+        """
+        return "page:%d:%d:%s:%d:%d" % (wiki_id, page_id, role, version,
+            verified)
+
+    def get(self, key):
+        html = self.backend.get(key)
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def set(self, key, html):
+        self.backend.set(key, html)
+
+    def stats(self):
+        """ <- dictionary of hit, miss and eviction counters """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+        }
+
+
+class IdentityCache(object):
+    """ Remembers users by id for ttl seconds, so that the logged in user can
+        be identified without a query on most requests. Users are kept
+        detached from any database session; merge them into one before use.
+    """
+    def __init__(self, load, ttl=300):
+        """ -> function loading a detached user by id, or returning None;
+                 seconds a user is remembered for
+        """
+        self.load = load
+        self.ttl = ttl
+        self.users = {}
+        self.lock = Lock()
+
+    def get(self, user_id):
+        """ -> user id
+            <- detached user; None if there is no such user
+        """
+        with self.lock:
+            entry = self.users.get(user_id)
+        if entry and entry[0] > time():
+            return entry[1]
+        user = self.load(user_id)
+        with self.lock:
+            if user is None:
+                self.users.pop(user_id, None)
+            else:
+                self.users[user_id] = (time() + self.ttl, user)
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
@@ -0,0 +1,214 @@
+####################
+#   Piki  Mailer   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import socket
+import logging
+from datetime import datetime, timedelta
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
+from threading import Event, Lock, Thread
+import models
+from models import Mail
+
+try:
+    from sensitive_data import smtp_server
+except ImportError:
+    smtp_server = "smtp.gmail.com:587"
+try:
+    from sensitive_data import email_password
+except ImportError:
+    email_password = None
+
+# Seconds between looks at the queue when nothing wakes the worker.
+POLL_INTERVAL = 30.0
+# Seconds before the first retry of a failed message; doubles every attempt.
+RETRY_DELAY = 60.0
+MAX_ATTEMPTS = 8
+# Seconds an unused connection is kept open.
+IDLE_TIMEOUT = 60.0
+# Seconds a message being sent is held back from other mailers, after which
+#   it is sent again in case the mailer that took it died.
+CLAIM_TIMEOUT = 600.0
+
+log = logging.getLogger('piki.mail')
+log.addHandler(logging.NullHandler())
+
+
+class Mailer(object):
+    """ Sends the mail queued in the database from a background thread, so
+        that requests never wait on the mail server. One SMTP connection is
+        kept open between messages and opened again when it drops. Every
+        message is claimed before it is sent, so that mailers in several
+        processes never send the same one. Messages that fail are retried
+        after a delay that doubles with every attempt, and are left in the
+        queue, marked as failed, after the last one.
+    """
+    def __init__(self, server=smtp_server, password=email_password,
+            interval=POLL_INTERVAL, retry_delay=RETRY_DELAY,
+            max_attempts=MAX_ATTEMPTS, idle_timeout=IDLE_TIMEOUT,
+            teardown=None):
+        """ -> SMTP server as host:port; password to log in with, or None to
+                 send without logging in; seconds between looks at the
+                 queue; seconds before the first retry; attempts before a
+                 message is given up on; seconds to keep an unused
+                 connection open; function to call after each round of
+                 sending
+        """
+        self.server = server
+        self.password = password
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.teardown = teardown
+        self.connection = None
+        self.last_used = None
+        self.sent = 0
+        self.retries = 0
+        self.wake = Event()
+        self.stopping = Event()
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        """ Starts the worker thread, unless it is running already. """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def notify(self):
+        """ Wakes the worker up to send newly queued mail. """
+        self.start()
+        self.wake.set()
+
+    def stop(self):
+        """ Stops the worker thread once it is done with its round. """
+        with self.lock:
+            thread = self.thread
+            self.stopping.set()
+            self.wake.set()
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopping.is_set():
+                return
+            try:
+                self.drain()
+            except Exception:
+                # Whatever went wrong, such as the database being away, the
+                #   queue is looked at again next round.
+                log.exception("Sending queued mail failed.")
+                models.session.rollback()
+            finally:
+                if self.teardown:
+                    self.teardown()
+
+    def drain(self):
+        """ Sends every message that is due, and closes the connection if it
+            has not been used for a while.
+        <- number of messages sent
+        """
+        sent = 0
+        while True:
+            mail = Mail.query.filter(Mail.attempts < self.max_attempts) \
+                .filter(Mail.send_date <= datetime.now()) \
+                .order_by(Mail.send_date).first()
+            if not mail:
+                break
+            if not self.claim(mail):
+                continue
+            try:
+                self.send(mail)
+            except (SMTPException, socket.error):
+                self.close()
+                mail.attempts += 1
+                mail.send_date = datetime.now() + timedelta(
+                    seconds=self.retry_delay * 2 ** (mail.attempts - 1))
+                self.retries += 1
+                models.session.commit()
+                # The server is likely still unreachable; wait for the next
+                #   round rather than failing every message now.
+                break
+            mail.delete()
+            models.session.commit()
+            sent += 1
+        if self.connection and \
+                datetime.now() - self.last_used > \
+                timedelta(seconds=self.idle_timeout):
+            self.close()
+        return sent
+
+    def claim(self, mail):
+        """ Puts a due message off for a while, unless another mailer has
+            already done so, to keep other mailers from sending it too.
+        -> queued mail
+        <- whether this mailer got it
+        """
+        claimed = Mail.query.filter_by(id=mail.id, send_date=mail.send_date) \
+            .update({'send_date': datetime.now() + timedelta(
+                seconds=CLAIM_TIMEOUT)}, synchronize_session=False)
+        models.session.commit()
+        return claimed == 1
+
+    def send(self, mail):
+        """ Sends a message over the open connection, opening one if needed.
+        -> queued mail
+        """
+        if self.connection is None:
+            self.connection = self.connect(mail.sender)
+        try:
+            self.connection.sendmail(mail.sender, mail.recipient,
+                mail.message.encode('utf-8'))
+        except SMTPServerDisconnected:
+            # The server may have dropped a connection that sat unused.
+            self.close()
+            self.connection = self.connect(mail.sender)
+            self.connection.sendmail(mail.sender, mail.recipient,
+                mail.message.encode('utf-8'))
+        self.last_used = datetime.now()
+        self.sent += 1
+
+    def connect(self, sender):
+        """ Opens a connection to the SMTP server, encrypting it and logging
+            in if the server and configuration allow.
+        -> address to log in as
+        <- SMTP connection
+        """
+        connection = SMTP(self.server)
+        connection.ehlo()
+        if connection.has_extn('starttls'):
+            connection.starttls()
+            connection.ehlo()
+        if self.password is not None:
+            connection.login(sender, self.password)
+        return connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (SMTPException, socket.error):
+                pass
+            self.connection = None
+
+    def stats(self):
+        """ Reports the state of the queue for monitoring.
+        <- dictionary of messages waiting, messages given up on, messages
+             sent and failed attempts since start
+        """
+        queued = Mail.query.filter(Mail.attempts < self.max_attempts).count()
+        failed = Mail.query.filter(Mail.attempts >= self.max_attempts).count()
+        return {'queued': queued, 'failed': failed, 'sent': self.sent,
+            'retries': self.retries}
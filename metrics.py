@@ -0,0 +1,188 @@
+####################
+#  Piki  Metrics   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import json
+import logging
+import cProfile
+import pstats
+import random
+from collections import deque
+from cStringIO import StringIO
+from threading import Lock, local
+from time import time
+from jinja2 import Template
+from sqlalchemy import event
+from flask import request
+
+# Durations kept per endpoint for percentiles.
+WINDOW = 1000
+# Profiles kept for /profiles!.
+PROFILES_KEPT = 20
+
+# One JSON object per request, for whatever handlers the server sets up.
+log = logging.getLogger('piki.requests')
+log.addHandler(logging.NullHandler())
+
+
+class TimedTemplate(Template):
+    """ A template that adds the time spent rendering it to the request's
+        timings. Templates included or extended are counted with it.
+    """
+    def render(self, *args, **kwargs):
+        timings = current()
+        start = time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            if timings is not None:
+                timings['render'] += time() - start
+
+
+state = local()
+
+def current():
+    """ Finds the timings of the request this thread is handling.
+    <- dictionary of timings, or None outside of a request
+    """
+    return getattr(state, 'timings', None)
+
+
+class Metrics(object):
+    """ Times every request, its view, the queries it runs and the templates
+        it renders. The timings are sent back in a Server-Timing header, logged
+        as one JSON object per request and gathered per endpoint for
+        percentiles. A share of requests can also be run under cProfile.
+    """
+    def __init__(self, app=None, engine=None, profile_rate=0.0):
+        """ -> Flask application; SQLAlchemy engine; share of requests to
+                 profile, from 0 to 1
+        """
+        self.profile_rate = profile_rate
+        self.durations = {}
+        self.profiles = deque(maxlen=PROFILES_KEPT)
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app, engine)
+
+    def init_app(self, app, engine):
+        # Started before any other request function, so that their queries
+        #   are counted too.
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start)
+        # Flask calls after request functions last registered first, so
+        #   this one is put first to finish after the others.
+        app.after_request_funcs.setdefault(None, []).insert(0, self.finish)
+        app.teardown_request(self.teardown)
+        app.jinja_env.template_class = TimedTemplate
+        dispatch = app.dispatch_request
+        def timed_dispatch():
+            timings = current()
+            start = time()
+            try:
+                return dispatch()
+            finally:
+                if timings is not None:
+                    timings['view'] += time() - start
+        app.dispatch_request = timed_dispatch
+        event.listen(engine, 'before_cursor_execute', self.query_started)
+        event.listen(engine, 'after_cursor_execute', self.query_finished)
+
+    def start(self):
+        state.timings = {'start': time(), 'db': 0.0, 'queries': 0,
+            'view': 0.0, 'render': 0.0}
+        state.profile = None
+        if self.profile_rate and random.random() < self.profile_rate:
+            state.profile = cProfile.Profile()
+            state.profile.enable()
+
+    def query_started(self, conn, cursor, statement, parameters, context,
+            executemany):
+        timings = current()
+        if timings is not None:
+            timings['query_start'] = time()
+
+    def query_finished(self, conn, cursor, statement, parameters, context,
+            executemany):
+        timings = current()
+        if timings is not None and 'query_start' in timings:
+            timings['db'] += time() - timings.pop('query_start')
+            timings['queries'] += 1
+
+    def finish(self, response):
+        timings = current()
+        if timings is None:
+            return response
+        state.timings = None
+        total = time() - timings['start']
+        if state.profile is not None:
+            state.profile.disable()
+            self.keep_profile(state.profile, total)
+            state.profile = None
+        endpoint = request.endpoint or 'none'
+        response.headers['Server-Timing'] = ', '.join([
+            'db;desc="%d queries";dur=%.1f' % (timings['queries'],
+                timings['db'] * 1000),
+            'view;dur=%.1f' % (timings['view'] * 1000),
+            'render;dur=%.1f' % (timings['render'] * 1000),
+            'total;dur=%.1f' % (total * 1000)])
+        log.info(json.dumps({'endpoint': endpoint, 'method': request.method,
+            'path': request.path, 'status': response.status_code,
+            'ms': round(total * 1000, 1), 'queries': timings['queries'],
+            'db_ms': round(timings['db'] * 1000, 1),
+            'view_ms': round(timings['view'] * 1000, 1),
+            'render_ms': round(timings['render'] * 1000, 1)}))
+        with self.lock:
+            self.durations.setdefault(endpoint, deque(maxlen=WINDOW)) \
+                .append(total)
+        return response
+
+    def teardown(self, exception=None):
+        """ Stops the profiler and drops the timings of a request that
+            ended without a response to finish, such as one that raised.
+        """
+        if getattr(state, 'profile', None) is not None:
+            state.profile.disable()
+        state.profile = None
+        state.timings = None
+
+    def keep_profile(self, profile, total):
+        output = StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(30)
+        report = '%s %s (%.1f ms)\n%s' % (request.method, request.path,
+            total * 1000, output.getvalue())
+        with self.lock:
+            self.profiles.append(report)
+
+    def recent_profiles(self):
+        """ Lists the latest profile reports.
+        <- array of reports, most recent first
+        """
+        with self.lock:
+            return list(reversed(self.profiles))
+
+    def stats(self):
+        """ Sums up the latest request durations of each endpoint.
+        <- dictionary of request count, median and 99th percentile in
+             milliseconds by endpoint
+        """
+        with self.lock:
+            durations = dict((endpoint, sorted(values))
+                for endpoint, values in self.durations.iteritems())
+        return dict((endpoint, {'count': len(values),
+            'p50': round(percentile(values, 0.5) * 1000, 1),
+            'p99': round(percentile(values, 0.99) * 1000, 1)})
+            for endpoint, values in durations.iteritems())
+
+
+def percentile(values, fraction):
+    """ Picks a percentile by the nearest rank.
+    -> sorted array of numbers; fraction of them below the percentile
+    <- percentile
+    """
+    return values[min(int(fraction * len(values)), len(values) - 1)]
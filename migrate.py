@@ -0,0 +1,245 @@
+####################
+#  Piki Migration  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+""" Brings an existing database up to date with the schema in models.py.
+    Missing tables are created first, so this also sets up a fresh database.
+    The server never touches the schema itself; run this before starting it
+    on a new or upgraded database:  python migrate.py
+    Every migration checks the schema first and is safe to run again.
+    The counters kept on wikis can be checked against their pages with
+    python migrate.py check, and corrected with python migrate.py repair.
+    Deleted wikis left unreclaimed by a restart are cleared away with
+    python migrate.py reclaim. Content stored before it was compressed is
+    compressed with python migrate.py compress.
+"""
+
+import sys
+from sqlalchemy import text, select, func, bindparam
+from sqlalchemy.engine.reflection import Inspector
+import models
+from models import User, Wiki, Page, Posting, Block, Revision, block_pattern
+
+
+def column_names(engine, table):
+    """ Lists the names of the columns that exist in a table.
+    -> database engine; table
+    <- set of column names
+    """
+    inspector = Inspector.from_engine(engine)
+    return set(column['name'] for column in inspector.get_columns(table.name))
+
+
+def index_names(engine, table):
+    """ Lists the names of the indexes that exist on a table.
+    -> database engine; table
+    <- set of index names
+    """
+    inspector = Inspector.from_engine(engine)
+    return set(index['name'] for index in inspector.get_indexes(table.name))
+
+
+def create_missing_indexes(engine, table):
+    """ Creates the indexes declared on a table that the database lacks.
+    -> database engine; table
+    """
+    existing = index_names(engine, table)
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+
+# # Migrations # #
+def slug_indexes(engine):
+    """ Adds the unique (author, slug) and (wiki, slug) lookup indexes. Pages
+        sharing a slug within a wiki get their id appended so the index can
+        be built.
+    """
+    page = Page.table
+    engine.execute("UPDATE %s SET title_slug = title_slug || '-' || id "
+        "WHERE id NOT IN (SELECT MIN(id) FROM %s GROUP BY wiki_id, "
+        "title_slug)" % (page.name, page.name))
+    create_missing_indexes(engine, Wiki.table)
+    create_missing_indexes(engine, page)
+
+
+def block_storage(engine):
+    """ Splits the content column of older pages into content blocks, then
+        empties the column. The column itself is left in place.
+    """
+    page = Page.table
+    if 'content' not in column_names(engine, page):
+        return
+    rows = engine.execute("SELECT id, content FROM %s WHERE content IS NOT "
+        "NULL" % page.name)
+    for page_id, content in rows.fetchall():
+        blocks = [{'page_id': page_id, 'position': i, 'html': html} 
+            for i, html in enumerate(block_pattern.findall(content))]
+        if blocks:
+            engine.execute(Block.table.insert(), blocks)
+        engine.execute(text("UPDATE %s SET content = NULL WHERE id = :id"
+            % page.name), id=page_id)
+
+
+def version_columns(engine):
+    """ Adds the version counters that guard wikis and pages against
+        concurrent changes.
+    """
+    for table in [Wiki.table, Page.table]:
+        if 'version' not in column_names(engine, table):
+            engine.execute("ALTER TABLE %s ADD COLUMN version INTEGER "
+                "DEFAULT 1" % table.name)
+
+
+def search_index(engine):
+    """ Indexes the pages that have no search postings yet. """
+    import search
+    indexed = models.session.query(Posting.page_id).distinct()
+    for page in Page.query.filter(~Page.id.in_(indexed)):
+        search.index_page(page)
+        models.session.commit()
+
+
+def directory_index(engine):
+    """ Adds the (publicity, update date) index behind the /read directory.
+    """
+    create_missing_indexes(engine, Wiki.table)
+
+
+def wiki_counters(engine):
+    """ Adds the page count and last page kept on wikis, and fills them in.
+    """
+    wiki = Wiki.table
+    existing = column_names(engine, wiki)
+    if 'page_count' not in existing:
+        engine.execute("ALTER TABLE %s ADD COLUMN page_count INTEGER "
+            "DEFAULT 0" % wiki.name)
+    if 'last_page_id' not in existing:
+        engine.execute("ALTER TABLE %s ADD COLUMN last_page_id INTEGER"
+            % wiki.name)
+    check_counters(repair=True)
+
+
+def password_length(engine):
+    """ Widens the password column for PBKDF2 hashes. SQLite never enforces
+        the length of a column, so there is nothing to do there.
+    """
+    if engine.dialect.name == 'sqlite':
+        return
+    user = User.table
+    inspector = Inspector.from_engine(engine)
+    length = dict((column['name'], getattr(column['type'], 'length', None))
+        for column in inspector.get_columns(user.name))['password']
+    if length is None or length >= user.c.password.type.length:
+        return
+    if engine.dialect.name == 'mysql':
+        engine.execute("ALTER TABLE %s MODIFY password VARCHAR(128)"
+            % user.name)
+    else:
+        engine.execute("ALTER TABLE %s ALTER COLUMN password TYPE "
+            "VARCHAR(128)" % user.name)
+
+
+def posting_index(engine):
+    """ Replaces the (term, wiki) index of search postings with one that
+        covers every column searches read.
+    """
+    posting = Posting.table
+    create_missing_indexes(engine, posting)
+    if 'ix_models_posting_term_wiki_id' in index_names(engine, posting):
+        if engine.dialect.name == 'mysql':
+            engine.execute("DROP INDEX ix_models_posting_term_wiki_id ON %s"
+                % posting.name)
+        else:
+            engine.execute("DROP INDEX ix_models_posting_term_wiki_id")
+
+
+# Columns are added before any migration that loads wikis or pages.
+migrations = [slug_indexes, block_storage, version_columns, wiki_counters,
+    search_index, directory_index, password_length, posting_index]
+
+
+def check_counters(repair=False):
+    """ Compares the page count and last page kept on each wiki with its
+        pages, and reports the wikis where they have drifted apart.
+    -> whether to correct the drifted counters
+    <- number of wikis that had drifted
+    """
+    drifted = 0
+    for wiki in Wiki.query.order_by(Wiki.id):
+        page_count, last_page_id = wiki.recount()
+        if (wiki.page_count, wiki.last_page_id) == (page_count, last_page_id):
+            continue
+        drifted += 1
+        print "Wiki %d: %s pages ending at %s, counted %s ending at %s." % (
+            wiki.id, wiki.page_count, wiki.last_page_id, page_count,
+            last_page_id)
+        if repair:
+            wiki.page_count = page_count
+            wiki.last_page_id = last_page_id
+            models.session.commit()
+    return drifted
+
+
+def compress_content(chunk=500):
+    """ Rewrites long content stored uncompressed, by older versions or
+        before the threshold was lowered, so that it is stored compressed.
+        Both read the same, so this only saves space.
+    -> number of rows to rewrite per statement
+    <- number of values rewritten
+    """
+    engine = models.metadata.bind
+    rewritten = 0
+    for table, name in [(Block.table, 'html'), (Revision.table, 'snapshot'),
+            (Revision.table, 'delta')]:
+        column = table.c[name]
+        update = table.update().where(table.c.id == bindparam('row_id')) \
+            .values({name: bindparam('value', type_=column.type)})
+        last_id = 0
+        while True:
+            rows = engine.execute(select([table.c.id, column])
+                .where(table.c.id > last_id)
+                .where(func.length(column) > models.compression_threshold)
+                .where(~column.startswith(models.zlib_tag))
+                .where(~column.startswith(models.raw_tag))
+                .order_by(table.c.id).limit(chunk)).fetchall()
+            if not rows:
+                break
+            engine.execute(update, [{'row_id': row_id, 'value': value}
+                for row_id, value in rows])
+            rewritten += len(rows)
+            last_id = rows[-1][0]
+    return rewritten
+
+
+def migrate():
+    """ Creates any missing tables, then runs every migration in order. """
+    engine = models.metadata.bind
+    models.create_all()
+    for migration in migrations:
+        print "Running %s..." % migration.__name__
+        migration(engine)
+    print "Done."
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    models.setup()
+    if command == 'migrate':
+        migrate()
+    elif command == 'reclaim':
+        print "%d deleted wiki(s) reclaimed." % models.reclaim_buried()
+    elif command == 'compress':
+        print "%d value(s) rewritten." % compress_content()
+    elif command in ('check', 'repair'):
+        drifted = check_counters(repair=command == 'repair')
+        print "%d wiki(s) %s." % (drifted, 
+            'repaired' if command == 'repair' else 'out of step')
+        sys.exit(1 if drifted and command == 'check' else 0)
+    else:
+        sys.exit("usage: python migrate.py [migrate | check | repair | "
+            "reclaim | compress]")
@@ -7,27 +7,93 @@
 #   MIT  License   #
 ####################
 
-from datetime import datetime
-from smtplib import SMTP
+import os
+import re
+import json
+import zlib
+import base64
+from math import log
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
 from elixir import *
+from sqlalchemy import Index, func, or_, and_, create_engine, event
+from sqlalchemy.orm import undefer, joinedload
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.types import TypeDecorator
 
 local = True
 
-def setup():
-    if local:
-        metadata.bind = "sqlite:///database.sqlite"
-    else:
-        from sensitive_data import database_url
-        metadata.bind = database_url
+# A revision absorbs the saves made this long after it was started.
+revision_window = timedelta(minutes=10)
+# Every this many revisions a full snapshot is stored instead of a delta.
+snapshot_interval = 20
+# Deleted wikis are reclaimed this many pages per transaction.
+reclaim_chunk = 500
+# Content longer than this many characters is stored compressed.
+compression_threshold = 512
+
+def setup(url=None):
+    """ Connects to the database named by DATABASE_URL, or to the local or
+        configured one, and sets up the entities. Other settings are read
+        from the environment as well; see engine_options(). Tables are left
+        alone; migrate.py creates and upgrades them. Does nothing if the
+        database is already connected, so that every entry point can call it.
+    -> database URL, overriding the environment
+    """
+    if metadata.bind is not None:
+        return
+    url = url or os.environ.get('DATABASE_URL')
+    if not url:
+        if local:
+            url = "sqlite:///database.sqlite"
+        else:
+            from sensitive_data import database_url
+            url = database_url
+    engine = create_engine(url, **engine_options(url))
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', tune_sqlite)
+    metadata.bind = engine
     setup_all()
-    create_all()
+
+
+def engine_options(url):
+    """ Reads the connection pool settings from the environment. SQLite
+        opens a connection per checkout instead of pooling them.
+    -> database URL
+    <- dictionary of create_engine() keyword arguments
+    """
+    if url.startswith('sqlite'):
+        return {}
+    environ = os.environ
+    return {
+        'pool_size': int(environ.get('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(environ.get('DATABASE_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DATABASE_POOL_RECYCLE', 3600)),
+    }
+
+
+def tune_sqlite(connection, record):
+    """ Lets readers carry on while a write is committed, makes a writer wait
+        for a lock instead of failing at once, and syncs to disk only at
+        checkpoints. The wait is read from SQLITE_BUSY_TIMEOUT, in
+        milliseconds. Also adds the ln() function that search ranks with,
+        which other databases have built in.
+    -> new DB-API connection; its pool record
+    """
+    busy_timeout = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % busy_timeout)
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+    connection.create_function('ln', 1, log)
 
 
 class User(Entity):
     name = Field(Unicode(50))
     name_slug = Field(Unicode(50))
-    password = Field(Unicode(54))
+    password = Field(Unicode(128))
     email = Field(Unicode(50))
     wikis = OneToMany('Wiki')
     join_date = Field(DateTime, default=datetime.now)
@@ -37,12 +103,24 @@ class User(Entity):
         return '<User "%s">' % self.name
 
     def wiki_by_slug(self, wiki_slug):
-        for wiki in self.wikis:
-            if wiki.title_slug == wiki_slug:
-                return wiki
+        wiki = Wiki.query.filter_by(author=self, title_slug=wiki_slug).first()
+        if wiki:
+            return wiki
         raise NoResultFound("Wiki with slug '%s' by '%s' was not found."
             % (wiki_slug, self))
 
+    def wiki_list(self, published_only=False):
+        """ Lists the user's wikis, most recently updated first, without
+            loading any of their pages.
+        -> whether to list only published wikis
+        <- array of wikis
+        """
+        query = Wiki.query.filter_by(author=self) \
+            .order_by(Wiki.update_date.desc())
+        if published_only:
+            query = query.filter(Wiki.publicity == 2)
+        return query.all()
+
     def verification_code(self):
         try:
             from sensitive_data import generate_verification_code
@@ -50,14 +128,12 @@ class User(Entity):
         except ImportError:
             return 4 # guaranteed to be random.
 
-    def send_verification_email(self):
-        try:
-            email = "pikimailman@gmail.com"
-            from sensitive_data import email_password
-            password = email_password
-        except ImportError:
-            email = "???"
-            password = "???"
+    def queue_verification_email(self):
+        """ Queues the welcome email with the verification link for the mail
+            worker to send. The caller commits.
+        <- queued mail
+        """
+        email = "pikimailman@gmail.com"
         message = ("From: {0}\n"
             "To: {1}\n"
             "Subject: Piki bids you welcome."
@@ -72,13 +148,7 @@ class User(Entity):
             "write an email to skoofoo@gmail.com."
             ).format(email, self.email, self.name, self.name_slug, 
                 self.verification_code())
-
-        server = SMTP("smtp.gmail.com:587")
-        server.ehlo()
-        server.starttls()
-        server.login(email, password)
-        server.sendmail(email, user.email, message)
-        server.quit()
+        return Mail(sender=email, recipient=self.email, message=message)
 
 
 class Wiki(Entity):
@@ -86,43 +156,457 @@ class Wiki(Entity):
     title_slug = Field(Unicode(50), unique=True)
     pages = OneToMany('Page')
     first_page_id = Field(Integer)
+    # Kept up to date by every change to the index; see recount().
+    last_page_id = Field(Integer)
+    page_count = Field(Integer, default=0)
     author = ManyToOne('User')
     publicity = Field(Integer)
     autosave = Field(Integer, default=1)
     creation_date = Field(DateTime, default=datetime.now)
     update_date = Field(DateTime, default=datetime.now)
+    using_options(version_id_col='version')
+    using_table_options(Index('ix_models_wiki_author_id_title_slug',
+        'author_id', 'title_slug', unique=True),
+        Index('ix_models_wiki_publicity_update_date', 
+        'publicity', 'update_date'))
 
     def __repr__(self):
         return '<Wiki "%s">' % self.title
 
-    def page_by_slug(self, page_slug):
-        for page in self.pages:
-            if page.title_slug == page_slug:
-                return page
+    def page_by_slug(self, page_slug, content=False):
+        """ Looks a page of the wiki up by its slug. Its content blocks are
+            loaded when first used unless asked for here, which saves a
+            query for pages that are about to be rendered or changed.
+        -> page's slugified title; whether to load the content with the page
+        <- page
+        """
+        query = Page.query.filter_by(wiki=self, title_slug=page_slug)
+        if content:
+            query = query.options(joinedload('blocks'))
+        page = query.first()
+        if page:
+            return page
         raise NoResultFound("Page with slug '%s' in '%s' was not found."
             % (page_slug, self))
 
     def ordered_pages(self):
-        pages = []
-        pages.append(Page.query.filter_by(id=self.first_page_id).one())
-        next_page_id = pages[0].next_page_id
-        while next_page_id != -1:
-            pages.append(Page.query.filter_by(id=next_page_id).one())
-            next_page_id = pages[-1].next_page_id
-        return pages
+        """ Loads every page of the wiki in one query and orders them by
+            following the next_page_id chain in memory. Pages that the chain
+            never reaches are appended so they stay visible in the index.
+        <- array of pages in index order
+        """
+        ordered, orphans, cycle = walk_chain(self.first_page_id,
+            Page.query.filter_by(wiki=self).all())
+        return ordered + orphans
+
+    def index_faults(self):
+        """ Reports what is wrong with the wiki's page chain, if anything.
+        <- array of orphaned pages; page at which the chain loops or None
+        """
+        ordered, orphans, cycle = walk_chain(self.first_page_id,
+            Page.query.filter_by(wiki=self).all())
+        return orphans, cycle
+
+    def recount(self):
+        """ Works out the page count and the last page of the index from the
+            pages themselves, to check the maintained ones against.
+        <- number of pages; id of the last page in the chain or None
+        """
+        ordered, orphans, cycle = walk_chain(self.first_page_id,
+            Page.query.filter_by(wiki=self).all())
+        return len(ordered) + len(orphans), ordered[-1].id if ordered else None
+
+    def append_page(self, page):
+        """ Links a page to the end of the index and counts it. The caller
+            commits.
+        -> page, flushed so that it has an id
+        """
+        last_page = Page.get_by(id=self.last_page_id)
+        if last_page:
+            last_page.next_page_id = page.id
+        else:
+            self.first_page_id = page.id
+        page.next_page_id = -1
+        self.last_page_id = page.id
+        self.page_count += 1
+
+    @classmethod
+    def publication_stamp(cls, author=None):
+        """ Summarizes published wikis without loading them, so that pages
+            listing them can be validated cheaply.
+        -> author whose wikis to summarize; all authors if None
+        <- number of published wikis; latest update date among them
+        """
+        query = session.query(func.count(cls.id), func.max(cls.update_date)) \
+            .filter(cls.publicity == 2)
+        if author is not None:
+            query = query.filter(cls.author == author)
+        return query.one()
+
+    @classmethod
+    def published(cls, after=None, limit=50):
+        """ Lists published wikis, most recently updated first, together with
+            their authors. Pages of the list are picked by the position of
+            the last wiki on the previous page rather than by an offset.
+        -> (update date, id) of the wiki to continue after, None to start
+             from the top; maximum number of wikis
+        <- array of wikis
+        """
+        query = cls.query.filter(cls.publicity == 2) \
+            .options(joinedload('author')) \
+            .order_by(cls.update_date.desc(), cls.id.desc())
+        if after:
+            update_date, wiki_id = after
+            query = query.filter(or_(cls.update_date < update_date,
+                and_(cls.update_date == update_date, cls.id < wiki_id)))
+        return query.limit(limit).all()
 
     def permission_to_view(self, user):
         return user == self.author or self.publicity > 0
 
+    def purge(self):
+        """ Deletes the wiki and everything in it with a handful of set-based
+            statements, loading none of its pages. The caller commits.
+        """
+        delete_pages(session.query(Page.id).filter(Page.wiki_id == self.id))
+        Wiki.query.filter_by(id=self.id).delete(synchronize_session=False)
+        self.expunge()
+
+    def bury(self):
+        """ Hides the wiki at once and leaves its rows to reclaim_buried().
+            A wiki without an author is a tombstone; it loses its title too,
+            so that the title can be used again. The caller commits.
+        """
+        self.author = None
+        self.title = self.title_slug = None
+        self.publicity = 0
+
+
+def walk_chain(first_page_id, pages):
+    """ Orders pages by following their next_page_id links from the first one.
+    -> id of the first page; array of all pages in a wiki
+    <- array of chained pages in order; array of pages left out of the chain,
+         ordered by id; page whose link closes a cycle or None
+    """
+    by_id = dict((page.id, page) for page in pages)
+    ordered = []
+    seen = set()
+    cycle = None
+    page_id = first_page_id
+    while page_id in by_id:
+        if page_id in seen:
+            cycle = ordered[-1]
+            break
+        seen.add(page_id)
+        ordered.append(by_id[page_id])
+        page_id = by_id[page_id].next_page_id
+    orphans = sorted((page for page in pages if page.id not in seen),
+        key=lambda page: page.id)
+    return ordered, orphans, cycle
+
+
+def slugify(string):
+    """ Takes a string and turns it into a URL-friendly slug.
+    eg "Rise and shine, Mr. Freeman." -> "rise-and-shine-mr-freeman"
+         "It's already 2 PM..." -> "its-already-2-pm" 
+    """
+    # Imported here, as only requests that make slugs need it.
+    from unidecode import unidecode
+    s = string
+    s = unidecode(s) # Convert to ASCII
+    s = s.lower() # Make lowercase
+    s = re.sub(r'\s', '-', s) # Replace all whitespace with dashes
+    s = re.sub(r'-+', '-', s) # Remove any extra subsequent dashes
+    # Remove all non-alphanumeric non-dash characters
+    s = re.sub(r'[^a-zA-Z0-9-]', '', s)
+    s = s.strip('-') # Remove any leading or trailing dash
+    return s
+
+
+# Match '<' unless it opens an allowed tag (h1, h2, h3, p, b, i, u) and '>'
+#   unless it closes one, looking behind by tag length instead of reversing.
+unsafe_lt = re.compile(r"<(?!/?(?:h[123]|[pbiu])>)")
+unsafe_gt = re.compile(r">(?<!<[pbiu]>)(?<!</[pbiu]>)"
+    r"(?<!<h[123]>)(?<!</h[123]>)")
+escapes = {'<': '&lt;', '>': '&gt;'}
+
+def sanitize(html):
+    """ Escapes every angle bracket that is not part of an allowed tag, with
+        plain string replacements. Escaping the '>' first cannot change how
+        a '<' is judged, as the '>' of an allowed tag is always kept.
+    eg "<p>1 < 2 <i>and</i> <script></p>" 
+         -> "<p>1 &lt; 2 <i>and</i> &lt;script&gt;</p>"
+    """
+    return unsafe_lt.sub('&lt;', unsafe_gt.sub('&gt;', html))
+
+def escape_title(title):
+    """ Escapes the angle brackets of a title for its page's heading. Titles
+        taken from headings already have them escaped, and ampersands are
+        left alone so that their entities are not escaped twice.
+    eg "1 < 2 <script>" -> "1 &lt; 2 &lt;script&gt;"
+    """
+    return re.sub('[<>]', lambda match: escapes[match.group()], title)
+
+
+block_pattern = re.compile('<(?:h1|h2|h3|p)>.*?</(?:h1|h2|h3|p)>')
+
 
 class Page(Entity):
     wiki = ManyToOne('Wiki')
     title = Field(Unicode(50))
     title_slug = Field(Unicode(50))
-    content = Field(UnicodeText, default=u"<h1></h1>")
+    blocks = OneToMany('Block', order_by='position', 
+        cascade='all, delete-orphan')
+    revisions = OneToMany('Revision', lazy='dynamic',
+        cascade='all, delete-orphan')
     next_page_id = Field(Integer)
+    using_options(version_id_col='version')
+    using_table_options(Index('ix_models_page_wiki_id_title_slug',
+        'wiki_id', 'title_slug', unique=True))
 
     def __repr__(self):
         return '<Page "%s">' % self.title
 
-setup()
\ No newline at end of file
+    def get_content(self):
+        return u''.join(block.html for block in self.blocks)
+
+    def set_content(self, content):
+        """ Replaces every block of the page with the blocks of an HTML
+            string. Use the blocks directly to change only some of them.
+        -> page content HTML
+        """
+        self.blocks = [Block(position=i, html=html) for i, html in 
+            enumerate(block_pattern.findall(content))]
+
+    content = property(get_content, set_content)
+
+    def append_block(self, html):
+        """ Adds a block after the last one.
+        -> block HTML
+        <- new block
+        """
+        position = self.blocks[-1].position + 1 if self.blocks else 0
+        block = Block(position=position, html=html)
+        self.blocks.append(block)
+        return block
+
+
+    def record_revision(self):
+        """ Stores the page's current content in its history. Saves made
+            shortly after the latest revision was started are folded into it
+            instead of starting a new one. The caller commits.
+        <- revision holding the current content
+        """
+        blocks = [block.html for block in self.blocks]
+        now = datetime.now()
+        latest = self.revisions.order_by(Revision.id.desc()).first()
+        if latest and now - latest.date < revision_window:
+            if latest.snapshot is not None:
+                latest.snapshot = json.dumps(blocks)
+            else:
+                latest.delta = block_delta(latest.previous().blocks(), blocks)
+            return latest
+        if latest is None or latest.depth + 1 >= snapshot_interval:
+            return Revision(page=self, date=now, snapshot=json.dumps(blocks),
+                depth=0)
+        return Revision(page=self, date=now, depth=latest.depth + 1,
+            delta=block_delta(latest.blocks(), blocks))
+
+
+# Stored content starting with this is zlib-compressed.
+zlib_tag = u'zlib:'
+# Stored content starting with this is the uncompressed text after it. Text
+#   starting with either tag is stored behind it, so that nothing written to
+#   a page reads back as anything but itself.
+raw_tag = u'raw:'
+
+def compress_text(text):
+    """ Compresses long text for storage, leaving it as it is if it is short
+        or does not shrink. The compressed bytes are base64-encoded behind a
+        format tag, so that they fit in a text column on every database.
+    -> text
+    <- text to store
+    """
+    if text is None:
+        return text
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    if len(text) > compression_threshold:
+        encoded = text.encode('utf-8')
+        stored = zlib_tag + base64.b64encode(zlib.compress(encoded, 6))
+        if len(stored) < len(encoded):
+            return stored
+    if text.startswith(zlib_tag) or text.startswith(raw_tag):
+        return raw_tag + text
+    return text
+
+
+def decompress_text(stored):
+    """ Reads text stored by compress_text(), or stored before it existed.
+        Tagged text that does not decompress, which only older versions
+        stored, reads as it was written.
+    -> stored text
+    <- text
+    """
+    if stored is None:
+        return stored
+    if stored.startswith(raw_tag):
+        return stored[len(raw_tag):]
+    if not stored.startswith(zlib_tag):
+        return stored
+    try:
+        return zlib.decompress(base64.b64decode(stored[len(zlib_tag):])) \
+            .decode('utf-8')
+    except (TypeError, ValueError, zlib.error):
+        return stored
+
+
+class CompressedText(TypeDecorator):
+    """ A text column that compresses long values; see compress_text(). """
+    impl = UnicodeText
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
+class Block(Entity):
+    page = ManyToOne('Page')
+    position = Field(Integer)
+    html = Field(CompressedText)
+    using_table_options(Index('ix_models_block_page_id_position',
+        'page_id', 'position'))
+
+    def __repr__(self):
+        return '<Block %d of %s>' % (self.position, self.page)
+
+def block_delta(old_blocks, new_blocks):
+    """ Describes how to turn one list of blocks into another.
+    -> array of old block HTML; array of new block HTML
+    <- JSON array of ["=", start, end] runs copied from the old blocks and
+         ["+", html, ...] runs of new blocks
+    """
+    delta = []
+    matcher = SequenceMatcher(None, old_blocks, new_blocks, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(['=', i1, i2])
+        elif j1 < j2:
+            delta.append(['+'] + new_blocks[j1:j2])
+    return json.dumps(delta)
+
+
+def apply_block_delta(old_blocks, delta):
+    """ Rebuilds a list of blocks from the one before it and a delta.
+    -> array of old block HTML; JSON delta made by block_delta
+    <- array of new block HTML
+    """
+    blocks = []
+    for run in json.loads(delta):
+        if run[0] == '=':
+            blocks.extend(old_blocks[run[1]:run[2]])
+        else:
+            blocks.extend(run[1:])
+    return blocks
+
+
+class Revision(Entity):
+    page = ManyToOne('Page')
+    date = Field(DateTime, default=datetime.now)
+    snapshot = Field(CompressedText, deferred=True)
+    delta = Field(CompressedText, deferred=True)
+    depth = Field(Integer)
+
+    def __repr__(self):
+        return '<Revision %d of %s>' % (self.id, self.page)
+
+    def previous(self):
+        return self.page.revisions.filter(Revision.id < self.id) \
+            .order_by(Revision.id.desc()).first()
+
+    def blocks(self):
+        """ Reconstructs the revision's content from the nearest snapshot at
+            or before it, which is at most snapshot_interval revisions back.
+        <- array of block HTML
+        """
+        chain = self.page.revisions.filter(Revision.id <= self.id) \
+            .order_by(Revision.id.desc()).limit(self.depth + 1) \
+            .options(undefer('snapshot'), undefer('delta')).all()
+        blocks = json.loads(chain[-1].snapshot)
+        for revision in reversed(chain[:-1]):
+            blocks = apply_block_delta(blocks, revision.delta)
+        return blocks
+
+    def content(self):
+        return u''.join(self.blocks())
+
+
+class Posting(Entity):
+    term = Field(Unicode(50))
+    page = ManyToOne('Page')
+    wiki = ManyToOne('Wiki')
+    count = Field(Integer)
+    # Covers searches, which read nothing of a posting but these.
+    using_table_options(Index('ix_models_posting_term_wiki_id_page_id_count',
+        'term', 'wiki_id', 'page_id', 'count'))
+
+    def __repr__(self):
+        return '<Posting "%s" in %s>' % (self.term, self.page)
+
+
+class Mail(Entity):
+    sender = Field(Unicode(50))
+    recipient = Field(Unicode(50))
+    message = Field(UnicodeText)
+    attempts = Field(Integer, default=0)
+    # When to try sending next.
+    send_date = Field(DateTime, default=datetime.now)
+    using_table_options(Index('ix_models_mail_send_date', 'send_date'))
+
+    def __repr__(self):
+        return '<Mail to "%s">' % self.recipient
+
+
+class Autosave(Entity):
+    page = ManyToOne('Page')
+    # JSON array of changed content blocks, as sent by the client.
+    patch = Field(UnicodeText)
+    date = Field(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return '<Autosave of %s>' % self.page
+
+
+def delete_pages(page_ids):
+    """ Deletes pages along with their blocks, revisions, search postings
+        and queued autosaves without loading any of them. The caller commits.
+    -> query selecting page ids, or array of page ids
+    """
+    for entity in [Block, Revision, Posting, Autosave]:
+        entity.query.filter(entity.page_id.in_(page_ids)) \
+            .delete(synchronize_session=False)
+    Page.query.filter(Page.id.in_(page_ids)).delete(synchronize_session=False)
+
+
+def reclaim_buried(chunk=None):
+    """ Deletes the rows of buried wikis a chunk of pages per transaction, so
+        that no single transaction holds the database for long.
+    -> number of pages to delete per transaction; reclaim_chunk if None
+    <- number of wikis reclaimed
+    """
+    chunk = chunk or reclaim_chunk
+    reclaimed = 0
+    while True:
+        wiki = Wiki.query.filter(Wiki.author == None).first()
+        if not wiki:
+            return reclaimed
+        page_ids = [page_id for page_id, in session.query(Page.id)
+            .filter(Page.wiki_id == wiki.id).limit(chunk)]
+        if page_ids:
+            delete_pages(page_ids)
+        else:
+            wiki.purge()
+            reclaimed += 1
+        session.commit()
\ No newline at end of file
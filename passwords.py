@@ -0,0 +1,155 @@
+####################
+#  Piki Passwords  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import os
+import hashlib
+from multiprocessing import Pool, TimeoutError
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import gen_salt, safe_str_cmp, check_password_hash
+
+try:
+    from sensitive_data import password_iterations
+except ImportError:
+    password_iterations = 20000
+
+# Hashes are written as pbkdf2:sha256:<iterations>$<salt>$<hex digest>, the
+#   format later versions of werkzeug use, so they can read them as well.
+METHOD = 'sha256'
+SALT_LENGTH = 12
+# Processes doing the hashing, and requests allowed to wait for them.
+WORKERS = 2
+QUEUE_LIMIT = 16
+# Seconds a request waits for its hash before giving up.
+TIMEOUT = 10.0
+
+
+class Saturated(Exception):
+    """ Raised when too many passwords are waiting to be hashed. """
+
+
+def hash_password(password, iterations=None, salt=None):
+    """ Hashes a password with PBKDF2. Slow on purpose; see Hasher.
+    -> password; number of iterations, password_iterations if None; salt,
+         a new one if None
+    <- hash string
+    """
+    iterations = iterations or password_iterations
+    salt = salt or gen_salt(SALT_LENGTH)
+    digest = hashlib.pbkdf2_hmac(METHOD, password.encode('utf-8'),
+        salt.encode('utf-8'), iterations)
+    return 'pbkdf2:%s:%d$%s$%s' % (METHOD, iterations, salt,
+        digest.encode('hex'))
+
+
+def check_password(pwhash, password):
+    """ Checks a password against a PBKDF2 hash, or against an older salted
+        sha1 hash made by werkzeug.
+    -> hash string; password
+    <- whether the password matches
+    """
+    if not pwhash.startswith('pbkdf2:'):
+        return check_password_hash(pwhash, password)
+    try:
+        method, salt, digest = pwhash.split('$', 2)
+        iterations = int(method.split(':')[2])
+    except (ValueError, IndexError):
+        return False
+    return safe_str_cmp(hash_password(password, iterations, salt), pwhash)
+
+
+def guarded(function, *args):
+    """ Runs a function in the pool, handing back what it raises instead of
+        raising it, so that the job always completes and frees its slot.
+    -> function; its arguments
+    <- whether it returned; what it returned or raised
+    """
+    try:
+        return True, function(*args)
+    except Exception, error:
+        return False, error
+
+
+def outdated(pwhash):
+    """ Tells whether a hash was made with an older method or cost than the
+        current one, and should be made again once the password is known.
+    -> hash string
+    <- whether to hash the password again
+    """
+    return not pwhash.startswith('pbkdf2:%s:%d$' % (METHOD,
+        password_iterations))
+
+
+class Hasher(object):
+    """ Hashes and checks passwords in a small pool of processes, so that a
+        burst of logins cannot hold every request thread on the CPU. Only
+        so many jobs may be outstanding in the pool; further requests are
+        turned away at once with Saturated rather than queued behind them.
+        A job keeps its place until the pool finishes it, even if the
+        request that sent it stopped waiting.
+    """
+    def __init__(self, workers=WORKERS, queue_limit=QUEUE_LIMIT,
+            timeout=TIMEOUT):
+        """ -> number of hashing processes; number of requests allowed to
+                 wait for them; seconds to wait for a result
+        """
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.lock = Lock()
+        self.pool = None
+        self.slots = None
+        self.pid = None
+
+    def start(self):
+        """ Starts the pool, unless this process has one already. Servers
+            should call this before starting threads, as forking a threaded
+            process can leave the children stuck on locks held at the time.
+            Otherwise it is started on first use, and again in forked server
+            workers, which cannot use the pool or count the jobs of the
+            process they were forked from.
+        <- pool; semaphore of free job slots
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = Pool(self.workers)
+                self.slots = BoundedSemaphore(self.queue_limit)
+                self.pid = os.getpid()
+            return self.pool, self.slots
+
+    def run(self, function, *args):
+        pool, slots = self.start()
+        if not slots.acquire(False):
+            raise Saturated("Too many passwords are waiting to be hashed.")
+        try:
+            job = pool.apply_async(guarded, (function,) + args,
+                callback=lambda result: slots.release())
+        except Exception:
+            slots.release()
+            raise
+        try:
+            returned, result = job.get(self.timeout)
+        except TimeoutError:
+            raise Saturated("Hashing a password took too long.")
+        if not returned:
+            raise result
+        return result
+
+    def hash(self, password):
+        """ Hashes a password in the pool.
+        -> password
+        <- hash string
+        """
+        return self.run(hash_password, password)
+
+    def check(self, pwhash, password):
+        """ Checks a password against a hash in the pool.
+        -> hash string; password
+        <- whether the password matches
+        """
+        return self.run(check_password, pwhash, password)
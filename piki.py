@@ -7,34 +7,106 @@
 #   MIT  License   #
 ####################
 
+import os
 import re
-from datetime import datetime
+import json
+import gzip
+import mimetypes
+from datetime import datetime, timedelta
+from hashlib import sha1
 from math import ceil
-from flask import *
-from sqlalchemy.orm.exc import NoResultFound
-from werkzeug.security import generate_password_hash, check_password_hash
+from cStringIO import StringIO
+from flask import Flask, Response, g, request, session, flash, redirect, \
+    url_for, render_template, make_response, jsonify, send_from_directory, \
+    stream_with_context, abort
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
 from functools import wraps
-from unidecode import unidecode
+from threading import Lock, Thread
 import models
-from models import Wiki, Page, User
+from models import Wiki, Page, User, Revision, Autosave, slugify, \
+    sanitize, escape_title
+from cache import PageCache, LRUBackend, SharedBackend, IdentityCache
+import autosave
+from autosave import WriteBehind
+from mailer import Mailer
+import passwords
+from passwords import Hasher, Saturated
+import search
+import assets
+import archive
+from metrics import Metrics
 
 
 app = Flask(__name__)
+app.jinja_env.globals.update(asset_url=assets.asset_url, 
+    asset_urls=assets.asset_urls)
+# PROFILE_RATE is the share of requests to profile, from 0 to 1.
+metrics = Metrics(profile_rate=float(os.environ.get('PROFILE_RATE', 0)))
+# Replaced by a shared cache in create_app() if memcached is configured.
+page_cache = PageCache(LRUBackend())
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 try:
     from sensitive_data import secret_key
     app.secret_key = secret_key
 except ImportError:
     app.secret_key = "string_of_randomness"
-
+# Names of the users who may see the monitoring pages.
 try:
-    from flask.ext.exceptional import Exceptional
-    from sensitive_data import exceptional_key
-    app.config['EXCEPTIONAL_API_KEY'] = exceptional_key
-    app.config['EXCEPTIONAL_HTTP_CODES'] = set(xrange(400, 600))
-    exceptional = Exceptional(app)
+    from sensitive_data import admin_names
 except ImportError:
-    pass
+    admin_names = []
+
+initialized = False
+
+
+def create_app(database_url=None):
+    """ Readies the application to serve: connects to the database and sets
+        up the integrations that are configured. Importing this module does
+        none of it, so that workers and scripts start quickly; WSGI servers
+        should load piki:create_app() rather than piki:app. The tables must
+        already exist; see migrate.py. Calling this again does nothing.
+    -> database URL, overriding the environment
+    <- application
+    """
+    global initialized, page_cache
+    if initialized:
+        return app
+    models.setup(database_url)
+    metrics.init_app(app, models.metadata.bind)
+    # Forked now, while the process has no other threads.
+    hasher.start()
+    try:
+        from flask.ext.exceptional import Exceptional
+        from sensitive_data import exceptional_key
+        app.config['EXCEPTIONAL_API_KEY'] = exceptional_key
+        app.config['EXCEPTIONAL_HTTP_CODES'] = set(xrange(400, 600))
+        Exceptional(app)
+    except ImportError:
+        pass
+    try:
+        from werkzeug.contrib.cache import MemcachedCache
+        from sensitive_data import memcached_servers
+        page_cache = PageCache(SharedBackend(
+            MemcachedCache(memcached_servers)))
+    except ImportError:
+        pass
+    initialized = True
+    return app
+
+
+epoch = datetime(1970, 1, 1)
+directory_page_size = 50
+# Wikis with more pages than this are deleted in the background.
+background_deletion_threshold = 200
+# Responses shorter than this many bytes are sent uncompressed.
+compression_minimum = 500
+compressible_types = set(['text/html', 'text/plain', 'application/json',
+    'application/javascript', 'text/css'])
 
 
 # # Auxiliary Functions # #
@@ -50,38 +122,301 @@ def get_all(class_, **kwargs):
     return entities
 
 
-def slugify(string):
-    """ Takes a string and turns it into a URL-friendly slug.
-    eg "Rise and shine, Mr. Freeman." -> "rise-and-shine-mr-freeman"
-         "It's already 2 PM..." -> "its-already-2-pm" 
+def patch_blocks(page, patch):
+    """ Replaces changed blocks of a page with sanitized patch blocks, leaving
+        the unchanged ones untouched. Emptied blocks are removed afterwards so
+        that the patch indices keep pointing at the same blocks.
+    -> page; array of changed content blocks, 'undefined' if unchanged
+    """
+    content_blocks = list(page.blocks)
+    emptied = []
+    for i, html in enumerate(patch):
+        if html != 'undefined':
+            html = sanitize(html)
+            if i < len(content_blocks):
+                content_blocks[i].html = html
+                if not html:
+                    emptied.append(content_blocks[i])
+            elif html:
+                page.append_block(html)
+    for block in emptied:
+        page.blocks.remove(block)
+
+
+def make_room(wiki, title, page):
+    """ Frees a title for a page by appending " (alternative)" to the title
+        of the other page of the wiki that has its slug, if there is one.
+        The suffix is numbered if that title is taken as well.
+    -> wiki; title the page is about to take; page taking it
+    """
+    taken = Page.get_by(wiki=wiki, title_slug=slugify(title))
+    if not taken or taken is page:
+        return
+    suffix = u' (alternative)'
+    number = 1
+    while Page.get_by(wiki=wiki, title_slug=slugify(taken.title + suffix)):
+        number += 1
+        suffix = u' (alternative %d)' % number
+    header_end = 4 + len(taken.title)
+    taken.title += suffix
+    taken.title_slug = slugify(taken.title)
+    taken.content = taken.content[:header_end] + suffix + \
+        taken.content[header_end:]
+    taken.record_revision()
+    search.index_page(taken)
+
+
+def apply_autosaves(page_id, attempts=3):
+    """ Applies a page's queued content patches, in the order they were
+        stored, and takes them off the queue in the same transaction.
+        Starts over if another write to the wiki gets there first, and
+        leaves them to another process that has already taken them.
+    -> page id; number of times to try
+    <- whether there were patches to apply
+    """
+    for attempt in range(attempts):
+        queued = Autosave.query.filter_by(page_id=page_id) \
+            .order_by(Autosave.id).all()
+        if not queued:
+            return False
+        taken = Autosave.query.filter(Autosave.id.in_([entry.id
+            for entry in queued])).delete(synchronize_session=False)
+        if taken != len(queued):
+            models.session.rollback()
+            continue
+        page = Page.get_by(id=page_id)
+        if page:
+            for entry in queued:
+                patch_blocks(page, json.loads(entry.patch))
+            page.record_revision()
+            search.index_page(page)
+            page.wiki.update_date = datetime.now()
+        try:
+            models.session.commit()
+        except StaleDataError:
+            models.session.rollback()
+            if attempt == attempts - 1:
+                raise
+        else:
+            return True
+    return False
+
+# AUTOSAVE_DELAY is how many seconds patches wait to be applied together; 0
+#   applies each one as it is saved.
+autosaves = WriteBehind(apply_autosaves, delay=float(os.environ.get(
+    'AUTOSAVE_DELAY', autosave.DEFAULT_DELAY)),
+    teardown=models.session.remove)
+mailer = Mailer(teardown=models.session.remove)
+hasher = Hasher()
+
+
+reclaiming = Lock()
+
+def reclaim_later():
+    """ Reclaims the rows of buried wikis in a background thread. """
+    def reclaim():
+        with reclaiming:
+            try:
+                models.reclaim_buried()
+            finally:
+                models.session.remove()
+    thread = Thread(target=reclaim)
+    thread.daemon = True
+    thread.start()
+
+
+def entity_tag(*parts):
+    """ Builds a strong entity tag out of the values a response depends on.
+    -> one or more values
+    <- hexadecimal digest string
+    """
+    return sha1(':'.join(unicode(part) for part in parts)
+        .encode('utf-8')).hexdigest()
+
+
+def accepted_encoding():
+    """ Picks the best compression the client accepts.
+    <- 'br', 'gzip' or None
+    """
+    if brotli and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """ Compresses a response body.
+    -> response body; 'br' or 'gzip'
+    <- compressed body
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if encoding == 'br':
+        return brotli.compress(body)
+    output = StringIO()
+    compressed = gzip.GzipFile(fileobj=output, mode='wb', compresslevel=6,
+        mtime=0)
+    compressed.write(body)
+    compressed.close()
+    return output.getvalue()
+
+
+def conditional(etag, last_modified, render, key=None):
+    """ Answers a GET with 304 Not Modified when the client's copy is current,
+        so the body is never rendered for it; otherwise renders the body,
+        compressed if the client accepts it. Either way the validators are
+        attached and the client is asked to revalidate before reusing its
+        copy.
+    -> entity tag; last modification date; function returning the body;
+         page cache key of the body, to cache its compressed copies beside it
+    <- response
     """
-    s = string
-    s = unidecode(s) # Convert to ASCII
-    s = s.lower() # Make lowercase
-    s = re.sub(r'\s', '-', s) # Replace all whitespace with dashes
-    s = re.sub(r'-+', '-', s) # Remove any extra subsequent dashes
-    # Remove all non-alphanumeric non-dash characters
-    s = re.sub(r'[^a-zA-Z0-9-]', '', s)
-    s = s.strip('-') # Remove any leading or trailing dash
-    return s
+    response = app.response_class()
+    encoding = accepted_encoding()
+    if encoding:
+        # Each encoding of the body is a representation of its own.
+        etag = entity_tag(etag, encoding)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    response.vary.add('Accept-Encoding')
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        since = request.if_modified_since
+        fresh = bool(since and last_modified and 
+            since >= last_modified.replace(microsecond=0))
+    if fresh:
+        response.status_code = 304
+    elif encoding:
+        body = page_cache.get('%s:%s' % (key, encoding)) if key else None
+        if body is None:
+            body = compress(render(), encoding)
+            if key:
+                page_cache.set('%s:%s' % (key, encoding), body)
+        response.data = body
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response.data = render()
+    return response
+
+
+def render_page(user, wiki, page):
+    """ Renders a wiki page, reusing the cached rendering if there is one.
+    -> wiki's author; wiki; page
+    <- rendered HTML
+    """
+    autosaves.try_flush(page.id)
+    role = 'author' if g.user == wiki.author else 'reader'
+    # Every write to a wiki, in any process, gives it a new version, and the
+    #   author's verification changes what the settings offer.
+    key = page_cache.key(wiki.id, page.id, role, wiki.version, 
+        user.verified)
+    def render():
+        html = page_cache.get(key)
+        if html is None:
+            # The key was built from the wiki as it was loaded. Ending the
+            #   transaction reloads it from a later snapshot, so the
+            #   rendering is never older than the version in its key.
+            models.session.rollback()
+            html = render_template('page.html', user=user, wiki=wiki, 
+                page=page)
+            page_cache.set(key, html)
+        return html
+    etag = entity_tag(wiki.id, wiki.update_date, page.id, role, 
+        user.verified)
+    return conditional(etag, wiki.update_date, render, key)
+
+
+def load_user(user_id):
+    """ Loads a user for the identity cache, detached from the session.
+    -> user id
+    <- user; None if there is no such user
+    """
+    user = User.get_by(id=user_id)
+    if user:
+        models.session.expunge(user)
+    return user
+
+identities = IdentityCache(load_user)
+
+
+def admin_only(view):
+    """ Hides a view from everyone but the users named in admin_names,
+        unless the server runs locally.
+    """
+    @wraps(view)
+    def guarded_view(*args, **kwargs):
+        if not models.local and not (g.user and g.user.name in admin_names):
+            abort(404)
+        return view(*args, **kwargs)
+    return guarded_view
 
 
 # # Request Functions # #
+@app.before_first_request
+def start_mailer():
+    """ Starts sending the mail left in the queue by an earlier run. """
+    if not models.local:
+        mailer.start()
+
 @app.before_request
 def before_request():
     """ Accounts for the logged in user before every request function. """
-    if 'name' in session:
-        try:
-            g.user = User.get_by(name=session['name'])
-        except NoResultFound:
-            session['name'] = None
-            g.user = None
-    else:
-        g.user = None
+    if session.get('name'):
+        # Sessions from before user ids were stored carry the name instead.
+        user = User.get_by(name=session.pop('name'))
+        if user:
+            session['user_id'] = user.id
+    user = None
+    if session.get('user_id'):
+        user = identities.get(session['user_id'])
+        if not user:
+            session.pop('user_id')
+    g.user = models.session.merge(user, load=False) if user else None
 
 @app.after_request
-def after_request(response):
-    models.session.close()
+def compress_response(response):
+    """ Compresses other text responses if the client accepts it. Files,
+        streams and responses already compressed are left alone.
+    """
+    encoding = accepted_encoding()
+    if not encoding or response.status_code != 200 or \
+            response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in compressible_types:
+        return response
+    body = response.data
+    if len(body) >= compression_minimum:
+        response.data = compress(body, encoding)
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.teardown_request
+def teardown_request(exception=None):
+    """ Ends the request's database session, whether or not it succeeded. """
+    models.session.remove()
+
+@app.errorhandler(StaleDataError)
+def conflict(error):
+    """ Answers a write that lost a race against another write to the same
+        wiki. Nothing was changed, so the client can send it again.
+    """
+    models.session.rollback()
+    return "conflict!", 409
+
+@app.errorhandler(Saturated)
+def saturated(error):
+    """ Turns a request away while too many passwords are being hashed,
+        rather than making it wait behind them.
+    """
+    models.session.rollback()
+    response = make_response("busy!", 503)
+    response.headers['Retry-After'] = '1'
     return response
 
 # TODO: Get this to work properly.
@@ -131,15 +466,18 @@ def signup():
             
         # Create the user and log in.
         name_slug = slugify(f['name'])
-        hashed_password = generate_password_hash(f['password'])
+        hashed_password = hasher.hash(f['password'])
         user = User(name=f['name'], name_slug=name_slug, \
             password=hashed_password, email=f['email'])
-        session['name'] = f['name']
         if models.local:
             user.verified = True
         else:
-            user.send_verification_email()
+            user.queue_verification_email()
         models.session.commit()
+        if not models.local:
+            mailer.notify()
+        identities.invalidate(user.id)
+        session['user_id'] = user.id
         return redirect(url_for('main'))
     elif request.method == 'GET':
         return redirect(url_for('main'))
@@ -165,6 +503,7 @@ def verify(user_slug, code):
     if code == user.verification_code():
         user.verified = 1
         models.session.commit()
+        identities.invalidate(user.id)
         flash("Verification was a success.")
         return redirect(url_for('main'))
     else:
@@ -180,14 +519,17 @@ def login():
     if request.method == 'POST':
         f = request.form
         # Try to log in as user.
-        try:
-            user = User.get_by(name=f['name'])
-        except NoResultFound:
+        user = User.get_by(name=f['name'])
+        if not user:
             flash("A user with that name does not exist.")
             return redirect(url_for('main'))
-        # If the password is correct, log the user in.
-        if check_password_hash(user.password, f['password']):
-            session['name'] = f['name']
+        # If the password is correct, log the user in, and bring the hash of
+        #   the password up to the current cost while it is known.
+        if hasher.check(user.password, f['password']):
+            if passwords.outdated(user.password):
+                user.password = hasher.hash(f['password'])
+                models.session.commit()
+            session['user_id'] = user.id
             return redirect(url_for('main'))
         else:
             forgot_url = url_for('forgot_password', name=user.name_slug)
@@ -199,7 +541,9 @@ def login():
 @app.route('/logout')
 def logout():
     """ Logs out the logged in user. """
-    session['name'] = None
+    user_id = session.pop('user_id', None)
+    if user_id:
+        identities.invalidate(user_id)
     return redirect(url_for('main'))
 
 @app.route('/forgot/<name>')
@@ -227,9 +571,11 @@ def write():
         wiki = Wiki(title=f['title'], title_slug=title_slug, author=g.user,
             publicity=0)
         page = Page(wiki=wiki, title=f['title'], title_slug=title_slug, 
-            content="<h1>%s</h1><p></p>" % f['title'], next_page_id=-1)
-        models.session.commit()
-        wiki.first_page_id = page.id
+            content="<h1>%s</h1><p></p>" % f['title'])
+        page.record_revision()
+        search.index_page(page)
+        models.session.flush()
+        wiki.append_page(page)
         models.session.commit()
         return redirect(url_for('wiki', user_slug=wiki.author.name_slug,
             wiki_slug=wiki.title_slug))
@@ -237,12 +583,44 @@ def write():
         if not g.user:
             flash("You must be logged in to do that.")
             return redirect(url_for('main'))
-        return render_template('write.html', wikis=g.user.wikis)
+        return render_template('write.html', wikis=g.user.wiki_list())
 
 @app.route('/read')
 def read():
-    """ Renders a public directory of wikis. """
-    return render_template('read.html', wikis=get_all(Wiki, publicity=2))
+    """ Renders a public directory of wikis, a page at a time.
+    -] after - cursor of the last wiki on the previous page
+    """
+    cursor = request.args.get('after', '')
+    try:
+        micros, wiki_id = [int(number) for number in cursor.split('-')]
+        if not 0 <= wiki_id < 2 ** 31:
+            raise OverflowError("Wiki id %d is out of range." % wiki_id)
+        after = (epoch + timedelta(microseconds=micros), wiki_id)
+    except ValueError:
+        cursor, after = '', None
+    except OverflowError:
+        return "bad cursor!", 400
+    count, last_update = Wiki.publication_stamp()
+    # The stamp changes whenever a wiki is published, hidden or updated, so
+    #   keying the rendering by it makes stale directory pages unreachable.
+    etag = entity_tag('read', count, last_update, cursor)
+    key = 'directory:%s' % etag
+    def render():
+        html = page_cache.get(key)
+        if html is None:
+            wikis = Wiki.published(after=after, limit=directory_page_size + 1)
+            next_cursor = None
+            if len(wikis) > directory_page_size:
+                wikis = wikis[:directory_page_size]
+                last = wikis[-1]
+                delta = last.update_date - epoch
+                next_cursor = '%d-%d' % (delta.days * 86400000000 + 
+                    delta.seconds * 1000000 + delta.microseconds, last.id)
+            html = render_template('read.html', wikis=wikis, 
+                next_cursor=next_cursor)
+            page_cache.set(key, html)
+        return html
+    return conditional(etag, last_update, render, key)
 
 @app.route('/:<name_slug>')
 def user(name_slug):
@@ -254,13 +632,12 @@ def user(name_slug):
     except NoResultFound:
         flash("This user does not exist.")
         return redirect(url_for('main'))
-    published_wikis = []
-    for wiki in user.wikis:
-        if wiki.publicity == 2:
-            published_wikis.append(wiki)
-    print published_wikis
-    return render_template('user.html', user=user, 
-        published_wikis=published_wikis)
+    def render():
+        return render_template('user.html', user=user, 
+            published_wikis=user.wiki_list(published_only=True))
+    count, last_update = Wiki.publication_stamp(author=user)
+    return conditional(entity_tag('user', user.id, count, last_update), 
+        last_update, render)
 
 @app.route('/:<user_slug>/<wiki_slug>', methods=['GET', 'POST'])
 def wiki(user_slug, wiki_slug):
@@ -284,17 +661,22 @@ def wiki(user_slug, wiki_slug):
     if request.method == 'POST':
         title = request.form['title']
         try:
-            Page.get_by(title_slug=slugify(title))
+            wiki.page_by_slug(slugify(title))
         except NoResultFound:
             page = Page(wiki=wiki, title=title, title_slug=slugify(title), 
                 content="<h1>%s</h1><p></p>" % title)
+            page.record_revision()
+            search.index_page(page)
+            models.session.flush()
+            wiki.append_page(page)
+            wiki.update_date = datetime.now()
             models.session.commit()
         return redirect(url_for('wiki_page', user_slug=user.name_slug, 
             wiki_slug=wiki.title_slug, page_slug=slugify(title)))
     else:
         page = wiki.page_by_slug(wiki_slug)
     if wiki.permission_to_view(g.user):
-        return render_template('page.html', user=user, wiki=wiki, page=page)
+        return render_page(user, wiki, page)
     else:
         flash("This wiki either is private or doesn't exist.")
         return redirect(url_for('main'))
@@ -321,7 +703,7 @@ def wiki_page(user_slug, wiki_slug, page_slug):
         return redirect(url_for('wiki', user_slug=user_slug, 
             wiki_slug=wiki_slug))
     if wiki.permission_to_view(user):
-        return render_template('page.html', user=user, wiki=wiki, page=page)
+        return render_page(user, wiki, page)
     else:
         flash("This wiki either is private or does not exist.")
         return redirect(url_for('main'))
@@ -368,6 +750,8 @@ def wiki_settings(user_slug, wiki_slug):
     if request.method == 'POST':
         f = request.form
         main_page = Page.get_by(wiki=wiki, title=wiki.title)
+        autosaves.flush(main_page.id)
+        make_room(wiki, f['title'] or "Untitled", main_page)
         wiki.title = f['title'] or "Untitled"
         wiki.title_slug = slugify(f['title'])
         main_page.title = wiki.title
@@ -377,6 +761,8 @@ def wiki_settings(user_slug, wiki_slug):
         title = re.compile(r"(<h1>)(.*)(</h1>)")
         main_page.content = title.sub(r"\1%s\3" % wiki.title, 
             main_page.content)
+        main_page.record_revision()
+        search.index_page(main_page)
         publicity = {
             'private': 0,
             'hidden': 1,
@@ -387,6 +773,7 @@ def wiki_settings(user_slug, wiki_slug):
         else:
             wiki.publicity = publicity[f['publicity']]
         wiki.autosave = 1 if f['autosave'] == 'on' else 0
+        wiki.update_date = datetime.now()
         models.session.commit()
         return slugify(f['title'])
     else:
@@ -395,6 +782,50 @@ def wiki_settings(user_slug, wiki_slug):
         return render_template('settings.html', user=user, wiki=wiki, 
             publicity=publicity, settings=True)
 
+@app.route('/:<user_slug>/<wiki_slug>/export!')
+def export_wiki(user_slug, wiki_slug):
+    """ Streams a wiki out as newline-delimited JSON; see archive.py.
+    -> user's slugified name; wiki's slugified title
+    """
+    user = User.get_by(name_slug=user_slug)
+    try:
+        wiki = user.wiki_by_slug(wiki_slug)
+    except (AttributeError, NoResultFound):
+        wiki = None
+    if not wiki or not wiki.permission_to_view(g.user):
+        flash("This wiki either is private or does not exist.")
+        return redirect(url_for('main'))
+    queued = models.session.query(Autosave.page_id).join(Page,
+        Autosave.page_id == Page.id).filter(Page.wiki_id == wiki.id) \
+        .distinct().all()
+    for page_id, in queued:
+        autosaves.try_flush(page_id)
+    response = Response(stream_with_context(archive.export_wiki(wiki)),
+        mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=%s.ndjson' % wiki.title_slug
+    return response
+
+@app.route('/import!', methods=['POST'])
+def import_wiki():
+    """ Creates a wiki for the logged in user from an exported one.
+    -] archive - file made by export_wiki
+    """
+    if not g.user:
+        flash("You must be logged in to do that.")
+        return redirect(url_for('main'))
+    upload = request.files.get('archive')
+    try:
+        wiki = archive.import_wiki(g.user, upload.stream)
+    except (AttributeError, StopIteration, ValueError, KeyError, TypeError):
+        models.session.rollback()
+        flash("That file is not an exported wiki.")
+        return redirect(url_for('write'))
+    wiki.update_date = datetime.now()
+    models.session.commit()
+    return redirect(url_for('wiki', user_slug=g.user.name_slug, 
+        wiki_slug=wiki.title_slug))
+
 @app.route('/:<user_slug>/<wiki_slug>/delete!')
 def delete_wiki(user_slug, wiki_slug):
     """ Deletes a wiki.
@@ -413,17 +844,14 @@ def delete_wiki(user_slug, wiki_slug):
         return redirect(url_for('main'))
     if user is g.user:
         title = wiki.title
-        pages = get_all(Page, wiki=wiki)
-        for page in pages:
-            if page in models.session.new:
-                page.expunge()
-            else:
-                page.delete()
-        if wiki in models.session.new:
-            wiki.expunge()
+        # Large wikis are hidden at once and reclaimed in the background.
+        if wiki.page_count > background_deletion_threshold:
+            wiki.bury()
+            models.session.commit()
+            reclaim_later()
         else:
-            wiki.delete()
-        models.session.commit()
+            wiki.purge()
+            models.session.commit()
         flash("Deletion of %s was a success." % title)
     else:
         flash("That is not your wiki, silly.")
@@ -433,23 +861,31 @@ def delete_wiki(user_slug, wiki_slug):
 def save(user_slug, wiki_slug, page_slug):
     """ Saves page changes in the database.
     -] patch - array of changed content blocks; 'undefined' if unchanged
+       sequence - number of the save, echoed in the X-Sequence header
     <- slugified page title
     """ 
     user = User.get_by(name_slug=user_slug)
     if user != g.user:
         return False
     wiki = user.wiki_by_slug(wiki_slug)
+    patch = request.form.getlist('patch')
+    keeps_title = not patch or patch[0] == 'undefined'
     try:
-        page = wiki.page_by_slug(page_slug)
+        page = wiki.page_by_slug(page_slug, content=not keeps_title)
     except NoResultFound:
-        old_last_page = Page.get_by(wiki=wiki, next_page_id=-1)
         page = Page(wiki=wiki, title="", title_slug="", 
-            content="<h1>Untitled</h1>", next_page_id=-1)
-        models.session.commit()
-        old_last_page.next_page_id = page.id
-    patch = request.form.getlist('patch')
-    block = re.compile('<(?:h1|h2|h3|p)>.*?</(?:h1|h2|h3|p)>')
-    content_blocks = block.findall(page.content)
+            content="<h1>Untitled</h1>")
+        models.session.flush()
+        wiki.append_page(page)
+    else:
+        # Changes that keep the title are stored now and applied in the
+        #   background along with the ones that follow them.
+        if keeps_title:
+            autosaves.add(page.id, patch)
+            response = make_response(page.title_slug)
+            response.headers['X-Sequence'] = request.form.get('sequence', '')
+            return response
+        autosaves.flush(page.id)
     # If the page's title has been changed in the content...
     new_title = page.title
     if len(patch) and patch[0] != 'undefined':
@@ -458,19 +894,14 @@ def save(user_slug, wiki_slug, page_slug):
         new_title = re.sub(newline, "", new_title)
     if page.title != new_title:
         # ..if a page exists with this title, append " (alternative)" to it.
-        try:
-            same_title_page = Page.get_by(title=new_title)
-        except NoResultFound:
-            pass
-        if same_title_page:
-            stp = same_title_page
-            header_end = 4 + len(stp.title)
-            stp.title += " (alternative)"
-            stp.title_slug = slugify(stp.title)
-            stp.content = stp.content[:header_end] + " (alternative)" + \
-                stp.content[header_end:]
+        make_room(wiki, new_title, page)
+        was_main_page = page.title == wiki.title
+        # ..change the page's title in the database, freeing its old slug.
+        page.title = new_title
+        page.title_slug = slugify(new_title)
+        models.session.flush()
         # ..if the page with changed title was the main page, make a new one.
-        if page.title == wiki.title:
+        if was_main_page:
             try:
                 if new_title:
                     second_page = page
@@ -483,86 +914,232 @@ def save(user_slug, wiki_slug, page_slug):
                 title_slug=slugify(wiki.title), 
                 content="<h1>%s</h1><p></p>" % wiki.title, 
                 next_page_id=next_page_id)
+            new_main_page.record_revision()
+            search.index_page(new_main_page)
             models.session.commit()
             wiki.first_page_id = new_main_page.id
-        # ..change the page's title in the database.
-        page.title = new_title
-        page.title_slug = slugify(new_title)
-    # Replace content with patched content.
-    for i, block in enumerate(patch):
-        if block != 'undefined':
-            if i < len(content_blocks):
-                content_blocks[i] = block
-            else:
-                content_blocks.append(block)
-    # Sanitize unsafe angle brackets.
-    content = ''.join(content_blocks)
-    unsafe_lt = re.compile(r"<(?!/?(h1|h2|h3|p|b|i|u)>)")
-    content = re.sub(unsafe_lt, '&lt;', content)
-    # The content is reversed to get around regex lookbehind limitation.
-    unsafe_gt = re.compile(r">(?!(1h|2h|3h|p|b|i|u)/?<)")
-    content = re.sub(unsafe_gt, ';tg&', content[::-1])
-    page.content = content[::-1]
+            wiki.page_count += 1
+            if next_page_id == -1:
+                wiki.last_page_id = new_main_page.id
+    patch_blocks(page, patch)
     # If the title is blank, delete the page.
     deleted = False
     blank_title = re.compile('<h1>(<br>)*</h1>')
     if blank_title.match(page.content):
-        try:
-            previous_page = Page.get_by(wiki=wiki, next_page_id=page.id)
+        previous_page = Page.get_by(wiki=wiki, next_page_id=page.id)
+        if previous_page:
             previous_page.next_page_id = page.next_page_id
-        except NoResultFound:
-            pass
+        if wiki.last_page_id == page.id:
+            wiki.last_page_id = previous_page and previous_page.id
+        wiki.page_count -= 1
+        search.unindex_page(page)
         page.delete()
         deleted = True
+    else:
+        page.record_revision()
+        search.index_page(page)
     # Update the wiki's update date.
     wiki.update_date = datetime.now()
     # Commit to database!
     models.session.commit()
     if not deleted:
-        return slugify(page.title)
+        response = make_response(slugify(page.title))
     else:
-        return "untitled!"
+        response = make_response("untitled!")
+    response.headers['X-Sequence'] = request.form.get('sequence', '')
+    return response
 
 @app.route('/:<user_slug>/<wiki_slug>/update-index!', methods=['POST'])
 def update_index(user_slug, wiki_slug):
     """ Update the order of pages in the index after a page is moved.
     -] page - the name of the moved page
-       previously_preceding_page - the page that used to be behind 'page'
        new_preceding_page - the page that is now behind 'page'
-    <- a string denoting success
+    <- a string denoting success; 'conflict!' with status 409 if the index
+         changed meanwhile
     """
     user = User.get_by(name_slug=user_slug)
     if user != g.user:
         return False
     wiki = user.wiki_by_slug(wiki_slug)
     f = request.form
-    ppp_name = f['previously_preceding']
     page_name = f['page']
     new_preceding_page_name = f['new_preceding']
-    try:
-        previously_preceding_page = Page.get_by(wiki=wiki, title=ppp_name)
-    except NoResultFound:
-        pass
     page = Page.get_by(wiki=wiki, title=page_name)
+    # The page behind the moved one is looked up rather than taken from the
+    #   client, whose index may be out of date.
+    previously_preceding_page = Page.get_by(wiki=wiki, next_page_id=page.id)
     try:
         new_preceding_page = Page.get_by(wiki=wiki, 
             title=new_preceding_page_name)
     except NoResultFound:
         pass
+    if new_preceding_page is page:
+        return "Success!"
+    if page.id == wiki.last_page_id and previously_preceding_page:
+        wiki.last_page_id = previously_preceding_page.id
     if page.id == wiki.first_page_id:
         wiki.first_page_id = page.next_page_id
-    else:
+    elif previously_preceding_page:
         previously_preceding_page.next_page_id = page.next_page_id
+    else:
+        # The index was read while another move was being committed, so
+        #   nothing is changed and the client sends the move again.
+        models.session.rollback()
+        return "conflict!", 409
     if new_preceding_page:
         page.next_page_id = new_preceding_page.next_page_id
         new_preceding_page.next_page_id = page.id
     else:
         page.next_page_id = wiki.first_page_id
         wiki.first_page_id = page.id
+    if page.next_page_id == -1:
+        wiki.last_page_id = page.id
+    wiki.update_date = datetime.now()
     models.session.commit()
     return "Success!"
 
+@app.route('/:<user_slug>/<wiki_slug>/<page_slug>/revisions!')
+def revisions(user_slug, wiki_slug, page_slug):
+    """ Renders a list of a page's revisions for its author.
+    -> user's slugified name; wiki's slugified title; page's slugified title
+    """
+    user = User.get_by(name_slug=user_slug)
+    if not g.user or user != g.user:
+        flash("That is not your wiki, silly.")
+        return redirect(url_for('main'))
+    try:
+        wiki = user.wiki_by_slug(wiki_slug)
+        page = wiki.page_by_slug(page_slug)
+    except NoResultFound:
+        flash("This page does not exist.")
+        return redirect(url_for('main'))
+    autosaves.try_flush(page.id)
+    return render_template('revisions.html', user=user, wiki=wiki, page=page,
+        revisions=page.revisions.order_by(Revision.id.desc()).all())
+
+@app.route('/:<user_slug>/<wiki_slug>/<page_slug>/revisions!/'
+    '<int:revision_id>', methods=['GET', 'POST'])
+def revision(user_slug, wiki_slug, page_slug, revision_id):
+    """ Renders a past revision of a page for its author, and restores it.
+    -> user's slugified name; wiki's slugified title; page's slugified title;
+         revision id
+    """
+    user = User.get_by(name_slug=user_slug)
+    if not g.user or user != g.user:
+        flash("That is not your wiki, silly.")
+        return redirect(url_for('main'))
+    try:
+        wiki = user.wiki_by_slug(wiki_slug)
+        page = wiki.page_by_slug(page_slug)
+    except NoResultFound:
+        flash("This page does not exist.")
+        return redirect(url_for('main'))
+    if request.method == 'POST':
+        autosaves.flush(page.id)
+    else:
+        autosaves.try_flush(page.id)
+    revision = page.revisions.filter_by(id=revision_id).first()
+    if not revision:
+        return redirect(url_for('revisions', user_slug=user_slug, 
+            wiki_slug=wiki_slug, page_slug=page_slug))
+    blocks = revision.blocks()
+    if request.method == 'POST':
+        # Keep the current title so the page stays where it is in the index.
+        blocks[:1] = ["<h1>%s</h1>" % escape_title(page.title)]
+        page.content = ''.join(blocks)
+        page.record_revision()
+        search.index_page(page)
+        wiki.update_date = datetime.now()
+        models.session.commit()
+        return redirect(url_for('wiki_page', user_slug=user_slug, 
+            wiki_slug=wiki_slug, page_slug=page_slug))
+    return render_template('revision.html', user=user, wiki=wiki, page=page,
+        revision=revision, content=''.join(blocks))
+
+@app.route('/search')
+def search_published():
+    """ Searches the pages of every published wiki.
+    -] q - search query
+    """
+    query = request.args.get('q', '')
+    return render_template('search.html', query=query, wiki=None,
+        results=search.search(query))
+
+@app.route('/:<user_slug>/<wiki_slug>/search!')
+def search_wiki(user_slug, wiki_slug):
+    """ Searches the pages of a single wiki.
+    -> user's slugified name; wiki's slugified title
+    -] q - search query
+    """
+    try:
+        user = User.get_by(name_slug=user_slug)
+    except NoResultFound:
+        flash("This user does not exist,<br />\
+            and consequently, their wiki does not either.")
+        return redirect(url_for('main'))
+    try:
+        wiki = user.wiki_by_slug(wiki_slug)
+    except NoResultFound:
+        flash("This wiki either is private or does not exist.")
+        return redirect(url_for('main'))
+    if not wiki.permission_to_view(g.user):
+        flash("This wiki either is private or does not exist.")
+        return redirect(url_for('main'))
+    query = request.args.get('q', '')
+    return render_template('search.html', query=query, wiki=wiki,
+        results=search.search(query, wiki=wiki))
+
+@app.route('/static/build/<path:filename>')
+def built_asset(filename):
+    """ Serves a file made by assets.py, compressed ahead of time if the
+        browser accepts it. Its name changes with its content, so browsers
+        may keep it forever.
+    -> file path relative to static/build
+    """
+    directory = os.path.join(app.static_folder, assets.BUILD)
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in [('br', '.br'), ('gzip', '.gz')]:
+        if request.accept_encodings[encoding] and \
+                os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix,
+                mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, 
+            mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/stats!')
+@admin_only
+def stats():
+    """ Reports the rendered page cache's counters for sizing it, the state
+        of the mail and autosave queues and how long each endpoint takes.
+    <- JSON object of cache hits, misses and evictions, of mail queued,
+         given up on, sent and retried, of autosaves queued, flushes and
+         failed flushes, and of request counts, medians and 99th
+         percentiles by endpoint
+    """
+    return jsonify(cache=page_cache.stats(), mail=mailer.stats(),
+        autosave=autosaves.stats(), requests=metrics.stats())
+
+@app.route('/profiles!')
+@admin_only
+def profiles():
+    """ Shows the latest profiled requests, most recent first. Requests are
+        profiled only if PROFILE_RATE is set.
+    <- plain text cProfile reports
+    """
+    response = make_response('\n\n'.join(metrics.recent_profiles()))
+    response.mimetype = 'text/plain'
+    return response
+
 if __name__ == '__main__':
+    create_app()
     if models.local == True:
         app.debug = True
+        # A fresh local database is created here; otherwise see migrate.py.
+        models.create_all()
     app.run()
\ No newline at end of file
@@ -0,0 +1,157 @@
+####################
+#   Piki  Search   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import re
+from math import log
+from flask import Markup, escape
+from sqlalchemy import func, case
+from sqlalchemy.orm import joinedload
+import models
+from models import Wiki, Page, Posting
+
+SNIPPET_RADIUS = 80
+
+block = re.compile(r'<(h1|h2|h3|p)>(.*?)</\1>')
+tag = re.compile(r'<[^>]*>')
+word = re.compile(r'\w+', re.UNICODE)
+
+
+def page_text(content):
+    """ Extracts the plain text of a page's content blocks.
+    -> page content HTML
+    <- text with one line per block
+    """
+    lines = []
+    for name, html in block.findall(content):
+        text = tag.sub('', html)
+        text = text.replace('&lt;', '<').replace('&gt;', '>') \
+            .replace('&nbsp;', ' ').replace('&amp;', '&')
+        lines.append(text)
+    return '\n'.join(lines)
+
+
+def tokenize(text):
+    """ Splits text into search terms, folding case and accents to ASCII.
+    eg "It's already 2 PM..." -> ["it", "s", "already", "2", "pm"]
+    """
+    from unidecode import unidecode
+    return [term[:50] for term in word.findall(unidecode(text).lower())]
+
+
+# # Index Maintenance # #
+def index_page(page):
+    """ Brings a page's postings up to date with its current content,
+        writing only those of terms whose count changed. The caller commits.
+    -> page
+    """
+    counts = term_counts(page.content)
+    if page.id is not None:
+        for posting in Posting.query.filter_by(page_id=page.id):
+            count = counts.pop(posting.term, None)
+            if count is None:
+                posting.delete()
+            elif count != posting.count:
+                posting.count = count
+    for term, count in counts.iteritems():
+        Posting(term=term, page=page, wiki=page.wiki, count=count)
+
+
+def term_counts(content):
+    """ Counts how many times each term occurs in a page.
+    -> page content HTML
+    <- dictionary of counts by term
+    """
+    counts = {}
+    for term in tokenize(page_text(content)):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def unindex_page(page):
+    """ Removes a page's postings. The caller commits.
+    -> page
+    """
+    if page.id is not None:
+        Posting.query.filter_by(page_id=page.id) \
+            .delete(synchronize_session=False)
+
+
+# # Querying # #
+def search(query, wiki=None, limit=20):
+    """ Ranks pages containing every term of a query by tf-idf. Only the
+        number of pages having each term is read; the pages are scored,
+        ranked and cut to the limit by the database.
+    -> query string; wiki to search in, or None for all published wikis;
+         maximum number of results
+    <- array of (page, snippet markup) tuples, best match first
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+    def scoped(query):
+        if wiki is not None:
+            return query.filter(Posting.wiki_id == wiki.id)
+        return query.join(Wiki, Posting.wiki_id == Wiki.id) \
+            .filter(Wiki.publicity == 2)
+    frequencies = dict(scoped(models.session.query(Posting.term,
+        func.count(Posting.page_id)).filter(Posting.term.in_(terms)))
+        .group_by(Posting.term))
+    if len(frequencies) < len(terms):
+        return []
+    pages = models.session.query(func.count(Page.id))
+    if wiki is not None:
+        pages = pages.filter(Page.wiki_id == wiki.id)
+    else:
+        pages = pages.join(Wiki, Page.wiki_id == Wiki.id) \
+            .filter(Wiki.publicity == 2)
+    total = pages.scalar()
+    idf = case([(Posting.term == term, log(float(total) / frequency) + 1)
+        for term, frequency in frequencies.iteritems()])
+    score = func.sum((1 + func.ln(Posting.count)) * idf)
+    best = [page_id for page_id, in scoped(models.session.query(
+        Posting.page_id).filter(Posting.term.in_(terms)))
+        .group_by(Posting.page_id)
+        .having(func.count(Posting.term) == len(terms))
+        .order_by(score.desc(), Posting.page_id).limit(limit)]
+    found = {}
+    if best:
+        # Every result needs its content for the snippet.
+        query = Page.query.filter(Page.id.in_(best)) \
+            .options(joinedload('blocks'))
+        found = dict((page.id, page) for page in query)
+    return [(found[page_id], snippet(found[page_id].content, terms))
+        for page_id in best if page_id in found]
+
+
+def snippet(content, terms):
+    """ Cuts the passage around the first matching term out of a page and
+        bolds the terms in it.
+    -> page content HTML; array of search terms
+    <- snippet markup
+    """
+    text = page_text(content).replace('\n', ' ')
+    terms = set(terms)
+    matches = [match for match in word.finditer(text)
+        if terms.intersection(tokenize(match.group()))]
+    start = max(matches[0].start() - SNIPPET_RADIUS, 0) if matches else 0
+    end = start + 2 * SNIPPET_RADIUS
+    pieces = []
+    position = start
+    for match in matches:
+        if match.start() >= start and match.end() <= end:
+            pieces.append(escape(text[position:match.start()]))
+            pieces.append(Markup('<b>%s</b>') % match.group())
+            position = match.end()
+    pieces.append(escape(text[position:end]))
+    markup = Markup('').join(pieces)
+    if start > 0:
+        markup = Markup('&hellip;') + markup
+    if end < len(text):
+        markup += Markup('&hellip;')
+    return markup
@@ -0,0 +1,68 @@
+####################
+#    Piki Tests    #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+""" Tests run against a throwaway SQLite database:
+        python -m unittest discover
+"""
+
+import os
+import shutil
+import atexit
+import tempfile
+
+directory = tempfile.mkdtemp(prefix='piki-test-')
+atexit.register(shutil.rmtree, directory, True)
+DATABASE_URL = 'sqlite:///%s' % os.path.join(directory, 'test.sqlite')
+
+
+def application():
+    """ Readies the server on the test database, creating its tables.
+    <- application
+    """
+    import piki
+    import models
+    piki.create_app(DATABASE_URL)
+    models.create_all()
+    piki.app.testing = True
+    return piki.app
+
+
+def make_wiki(author_name, title, page_titles, verified=True):
+    """ Creates a user, unless there is one by the name, with a published
+        wiki of chained pages.
+    -> user name; wiki title; titles of the pages after the main one;
+         whether a new user is verified
+    <- user; wiki
+    """
+    import models
+    import search
+    from models import User, Wiki, Page, slugify
+    user = User.get_by(name=author_name)
+    if not user:
+        user = User(name=author_name, name_slug=slugify(author_name),
+            email=u'%s@example.com' % slugify(author_name), password=u'',
+            verified=verified)
+    wiki = Wiki(title=title, title_slug=slugify(title), author=user,
+        publicity=2)
+    for page_title in [title] + list(page_titles):
+        page = Page(wiki=wiki, title=page_title,
+            title_slug=slugify(page_title),
+            content=u'<h1>%s</h1><p>%s</p>' % (page_title, page_title))
+        models.session.flush()
+        page.record_revision()
+        search.index_page(page)
+        wiki.append_page(page)
+    models.session.commit()
+    return user, wiki
+
+
+def log_in(client, user):
+    """ Logs a test client in as a user without checking a password. """
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
@@ -0,0 +1,122 @@
+####################
+#  Archive  Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import json
+import unittest
+from StringIO import StringIO
+import tests
+import piki
+import models
+import archive
+from models import User, Wiki, Page, Autosave
+
+
+def lines(title, pages, **header):
+    header.update(title=title, pages=len(pages))
+    return [json.dumps(header)] + [json.dumps({'title': page,
+        'content': u'<h1>%s</h1><p>%s</p>' % (page, page)})
+        for page in pages]
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+
+    def tearDown(self):
+        models.session.rollback()
+        models.session.remove()
+
+    def author(self, verified):
+        name = u'Importer %s' % verified
+        return User.get_by(name=name) or tests.make_wiki(name,
+            u'Home of %s' % name, [], verified)[0]
+
+    def test_an_exported_wiki_comes_back_the_same(self):
+        user, wiki = tests.make_wiki(u'Exporter', u'Round trip',
+            [u'One', u'Two', u'Three'])
+        exported = list(archive.export_wiki(wiki))
+        copy = archive.import_wiki(user, exported)
+        models.session.commit()
+        self.assertEqual(copy.title, u'Round trip (2)')
+        self.assertEqual([page.title for page in copy.ordered_pages()],
+            [u'Round trip (2)', u'One', u'Two', u'Three'])
+        self.assertEqual(copy.publicity, 2)
+
+    def test_publicity_is_kept_in_range(self):
+        author = self.author(True)
+        for given, kept in [(7, 2), (-3, 0), ('1', 1)]:
+            wiki = archive.import_wiki(author, lines(u'Ranged %s' % given,
+                [u'Main'], publicity=given))
+            self.assertEqual(wiki.publicity, kept)
+        self.assertRaises(ValueError, archive.import_wiki, author,
+            lines(u'Worded', [u'Main'], publicity='public'))
+
+    def test_unverified_authors_cannot_publish(self):
+        wiki = archive.import_wiki(self.author(False), lines(u'Unverified',
+            [u'Main'], publicity=2))
+        self.assertEqual(wiki.publicity, 1)
+
+    def test_the_main_page_title_is_escaped(self):
+        wiki = archive.import_wiki(self.author(True), lines(
+            u'<script>alert(1)</script>', [u'Renamed']))
+        content = Page.get_by(id=wiki.first_page_id).content
+        self.assertNotIn(u'<script>', content)
+        self.assertTrue(content.startswith(
+            u'<h1>&lt;script&gt;alert(1)&lt;/script&gt;</h1>'))
+
+    def test_archives_without_pages_are_refused(self):
+        self.assertRaises(ValueError, archive.import_wiki, self.author(True),
+            lines(u'Empty', []))
+
+    def test_malformed_archives_are_refused(self):
+        user = self.author(True)
+        user_id = user.id
+        models.session.commit()
+        count = Wiki.query.count()
+        client = self.app.test_client()
+        tests.log_in(client, user)
+        for content in ['[1, 2]', '{"title": "Listed"}\n[1]', '',
+                '{"title": "Empty"}\n']:
+            response = client.post('/import!', data={'archive':
+                (StringIO(content), 'wiki.ndjson')})
+            self.assertEqual(response.status_code, 302)
+        models.session.remove()
+        self.assertEqual(Wiki.query.count(), count)
+        self.assertTrue(User.get_by(id=user_id))
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+        self.delay = piki.autosaves.delay
+        piki.autosaves.delay = 60
+
+    def tearDown(self):
+        piki.autosaves.flush_all()
+        piki.autosaves.delay = self.delay
+        models.session.remove()
+
+    def test_only_the_exported_wiki_is_flushed(self):
+        user, wiki = tests.make_wiki(u'Flusher', u'Exported', [u'Kept'])
+        other = tests.make_wiki(u'Flusher', u'Elsewhere', [u'Waiting'])[1]
+        url = '/:%s/%s/export!' % (user.name_slug, wiki.title_slug)
+        kept = Page.get_by(wiki=wiki, title=u'Kept').id
+        waiting = Page.get_by(wiki=other, title=u'Waiting').id
+        piki.autosaves.add(kept, ['undefined', '<p>saved</p>'])
+        piki.autosaves.add(waiting, ['undefined', '<p>later</p>'])
+        response = self.app.test_client().get(url)
+        self.assertIn('<p>saved</p>', response.data)
+        models.session.remove()
+        self.assertEqual(Autosave.query.filter_by(page_id=kept).count(), 0)
+        self.assertEqual(Autosave.query.filter_by(page_id=waiting).count(),
+            1)
+
+
+if __name__ == '__main__':
+    unittest.main()
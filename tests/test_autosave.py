@@ -0,0 +1,159 @@
+####################
+#  Autosave Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import time
+import unittest
+from threading import Thread
+import tests
+import piki
+import models
+from models import Page, Autosave
+from autosave import WriteBehind
+
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+        self.delay = piki.autosaves.delay
+        # Long enough that nothing is applied behind the tests' backs.
+        piki.autosaves.delay = 60
+
+    def tearDown(self):
+        piki.autosaves.flush_all()
+        piki.autosaves.delay = self.delay
+        models.session.remove()
+
+    def make_wiki(self, title, page_titles):
+        user, wiki = tests.make_wiki(u'Typist', title, page_titles)
+        self.prefix = '/:%s/%s/' % (user.name_slug, wiki.title_slug)
+        self.user_id = user.id
+        return wiki
+
+    def client(self):
+        client = self.app.test_client()
+        tests.log_in(client, models.User.get_by(id=self.user_id))
+        return client
+
+    def save(self, client, page_slug, patch, sequence):
+        return client.post(self.prefix + page_slug + '/save!',
+            data={'patch': patch, 'sequence': str(sequence)})
+
+    def content(self, page_id):
+        models.session.remove()
+        return Page.get_by(id=page_id).content
+
+    def test_saves_are_stored_before_they_are_answered(self):
+        wiki = self.make_wiki(u'Durable', [u'Notes'])
+        page = Page.get_by(wiki=wiki, title=u'Notes')
+        page_id = page.id
+        response = self.save(self.client(), 'notes',
+            ['undefined', '<p>kept</p>'], 1)
+        self.assertEqual(response.headers['X-Sequence'], '1')
+        self.assertEqual(Autosave.query.filter_by(page_id=page_id).count(),
+            1)
+        # Another process applies them when it next needs the page.
+        other = WriteBehind(piki.apply_autosaves, delay=60)
+        other.flush(page_id)
+        self.assertEqual(self.content(page_id),
+            u'<h1>Notes</h1><p>kept</p>')
+        self.assertEqual(Autosave.query.filter_by(page_id=page_id).count(),
+            0)
+
+    def test_reading_applies_queued_saves(self):
+        wiki = self.make_wiki(u'Readable', [u'Draft'])
+        page_id = Page.get_by(wiki=wiki, title=u'Draft').id
+        client = self.client()
+        self.save(client, 'draft', ['undefined', '<p>read me</p>'], 1)
+        response = client.get(self.prefix + 'draft')
+        self.assertIn('read me', response.data)
+        self.assertEqual(Autosave.query.filter_by(page_id=page_id).count(),
+            0)
+
+    def test_title_change_follows_queued_saves(self):
+        wiki = self.make_wiki(u'Ordered', [u'Before'])
+        page_id = Page.get_by(wiki=wiki, title=u'Before').id
+        client = self.client()
+        self.save(client, 'before', ['undefined', '<p>one</p>'], 1)
+        self.save(client, 'before', ['undefined', '<p>one</p>',
+            '<p>two</p>'], 2)
+        response = self.save(client, 'before', ['<h1>After</h1>'], 3)
+        self.assertEqual(response.data, 'after')
+        self.assertEqual(response.headers['X-Sequence'], '3')
+        self.assertEqual(self.content(page_id),
+            u'<h1>After</h1><p>one</p><p>two</p>')
+
+    def test_failed_flushes_are_kept_counted_and_retried(self):
+        wiki = self.make_wiki(u'Failing', [u'Broken'])
+        page_id = Page.get_by(wiki=wiki, title=u'Broken').id
+        attempts = []
+        def apply(page_id):
+            attempts.append(page_id)
+            if len(attempts) == 1:
+                raise RuntimeError("The database went away.")
+            return piki.apply_autosaves(page_id)
+        autosaves = WriteBehind(apply, delay=0.05)
+        autosaves.add(page_id, ['undefined', '<p>survived</p>'])
+        for i in range(100):
+            if autosaves.flushes:
+                break
+            time.sleep(0.05)
+        self.assertEqual(autosaves.failures, 1)
+        self.assertEqual(autosaves.last_failure, 'page %d' % page_id)
+        self.assertEqual(self.content(page_id),
+            u'<h1>Broken</h1><p>survived</p>')
+
+    def test_reads_go_on_when_a_flush_fails(self):
+        autosaves = WriteBehind(lambda page_id: 1 / 0, delay=60)
+        self.assertFalse(autosaves.try_flush(1))
+        self.assertEqual(autosaves.failures, 1)
+
+    def test_typing(self):
+        # Several writers type into their own pages at once, saving after
+        #   every word as autosave does. Each page ends up with every word
+        #   in order, applied in far fewer flushes than there were saves.
+        writers, words = 4, 30
+        wiki = self.make_wiki(u'Typed', [u'Page %d' % i
+            for i in range(writers)])
+        page_ids = [Page.get_by(wiki=wiki, title=u'Page %d' % i).id
+            for i in range(writers)]
+        piki.autosaves.delay = 0.2
+        flushes = piki.autosaves.flushes
+        errors = []
+        def type_into(i):
+            try:
+                client = self.client()
+                text = u''
+                for word in range(words):
+                    text += u' w%d' % word
+                    response = self.save(client, 'page-%d' % i,
+                        ['undefined', u'<p>%s</p>' % text], word + 1)
+                    if response.status_code != 200 or \
+                            response.headers['X-Sequence'] != str(word + 1):
+                        errors.append(response.status)
+            finally:
+                models.session.remove()
+        threads = [Thread(target=type_into, args=[i])
+            for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        piki.autosaves.flush_all()
+        self.assertEqual(errors, [])
+        expected = u''.join(u' w%d' % word for word in range(words))
+        for i, page_id in enumerate(page_ids):
+            self.assertEqual(self.content(page_id),
+                u'<h1>Page %d</h1><p>%s</p>' % (i, expected))
+        flushes = piki.autosaves.flushes - flushes
+        self.assertEqual(Autosave.query.count(), 0)
+        self.assertTrue(flushes < writers * words / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
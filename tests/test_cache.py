@@ -0,0 +1,48 @@
+####################
+#   Cache  Tests   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import unittest
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+import tests
+import piki
+import models
+from models import Wiki, Page
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+
+    def tearDown(self):
+        models.session.remove()
+
+    def test_writes_of_other_processes_reach_cached_pages(self):
+        user, wiki = tests.make_wiki(u'Cacher', u'Cached', [u'Shared'])
+        url = '/:%s/%s/shared' % (user.name_slug, wiki.title_slug)
+        wiki_id = wiki.id
+        page_id = Page.get_by(wiki=wiki, title=u'Shared').id
+        client = self.app.test_client()
+        self.assertIn('<p>Shared</p>', client.get(url).data)
+        hits = piki.page_cache.hits
+        self.assertIn('<p>Shared</p>', client.get(url).data)
+        self.assertEqual(piki.page_cache.hits, hits + 1)
+        # Another process, with a session and page cache of its own.
+        other = sessionmaker(bind=models.metadata.bind)()
+        other.query(Page).get(page_id).blocks[1].html = u'<p>Changed</p>'
+        other.query(Wiki).get(wiki_id).update_date = datetime.now()
+        other.commit()
+        other.close()
+        response = client.get(url)
+        self.assertIn('<p>Changed</p>', response.data)
+        self.assertNotIn('<p>Shared</p>', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+####################
+# Concurrency Test #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import random
+import unittest
+from threading import Thread
+import tests
+import models
+from models import Wiki
+
+
+class ReorderTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+
+    def tearDown(self):
+        models.session.remove()
+
+    def test_concurrent_moves_keep_the_index_whole(self):
+        titles = [u'Page %d' % i for i in range(8)]
+        user, wiki = tests.make_wiki(u'Mover', u'Movable', titles)
+        user_id, wiki_id = user.id, wiki.id
+        url = '/:%s/%s/update-index!' % (user.name_slug, wiki.title_slug)
+        statuses = []
+        def move(seed):
+            rng = random.Random(seed)
+            client = self.app.test_client()
+            try:
+                tests.log_in(client, models.User.get_by(id=user_id))
+                for i in range(25):
+                    page, preceding = rng.sample(titles, 2)
+                    # Moves that lose a race are sent again, as the client
+                    #   does.
+                    for attempt in range(50):
+                        response = client.post(url, data={'page': page,
+                            'new_preceding': preceding})
+                        statuses.append(response.status_code)
+                        if response.status_code != 409:
+                            break
+            finally:
+                models.session.remove()
+        threads = [Thread(target=move, args=[seed]) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(statuses) - set([200, 409]), set())
+        models.session.remove()
+        wiki = Wiki.get_by(id=wiki_id)
+        orphans, cycle = wiki.index_faults()
+        self.assertEqual(orphans, [])
+        self.assertEqual(cycle, None)
+        self.assertEqual(wiki.recount(), (wiki.page_count, wiki.last_page_id))
+        self.assertEqual(wiki.page_count, len(titles) + 1)
+
+    def test_a_move_against_a_stale_index_is_refused(self):
+        user, wiki = tests.make_wiki(u'Mover', u'Stale', [u'First',
+            u'Second'])
+        url = '/:%s/%s/update-index!' % (user.name_slug, wiki.title_slug)
+        # A page that nothing links to, as if it were being moved.
+        page = models.Page.get_by(wiki=wiki, title=u'Second')
+        models.Page.get_by(wiki=wiki, next_page_id=page.id).next_page_id = -1
+        wiki.last_page_id = page.id - 1
+        page_id = page.id
+        models.session.commit()
+        client = self.app.test_client()
+        tests.log_in(client, user)
+        response = client.post(url, data={'page': u'Second',
+            'new_preceding': u'Stale'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(models.Page.get_by(id=page_id).next_page_id, -1)
+
+if __name__ == '__main__':
+    unittest.main()
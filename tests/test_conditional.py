@@ -0,0 +1,71 @@
+####################
+# Conditional GETs #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import gzip
+import unittest
+from StringIO import StringIO
+import tests
+import piki
+import models
+
+
+class ConditionalTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+        user, wiki = tests.make_wiki(u'Validator', u'Validated by %s'
+            % self._testMethodName, [u'Checked'])
+        self.prefix = '/:%s/%s/' % (user.name_slug, wiki.title_slug)
+        self.client = self.app.test_client()
+        tests.log_in(self.client, user)
+
+    def tearDown(self):
+        piki.autosaves.flush_all()
+        models.session.remove()
+
+    def get(self, **headers):
+        return self.client.get(self.prefix + 'checked', headers=headers)
+
+    def test_a_current_copy_is_not_sent_again(self):
+        response = self.get()
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.get(**{'If-None-Match': '"outdated"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_saving_changes_the_entity_tag(self):
+        etag = self.get().headers['ETag']
+        self.client.post(self.prefix + 'checked/save!',
+            data={'patch': ['undefined', '<p>changed</p>']})
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('<p>changed</p>', response.data)
+
+    def test_compressed_copies_are_their_own_representation(self):
+        plain = self.get()
+        response = self.get(**{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Cookie', response.headers['Vary'])
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.data))
+            .read(), plain.data)
+        response = self.get(**{'Accept-Encoding': 'gzip',
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+
+if __name__ == '__main__':
+    unittest.main()
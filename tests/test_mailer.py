@@ -0,0 +1,125 @@
+####################
+#   Mailer Tests   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import time
+import smtpd
+import socket
+import asyncore
+import unittest
+from datetime import datetime
+from threading import Thread
+import tests
+import models
+from models import Mail
+from mailer import Mailer
+
+
+class Recorder(smtpd.SMTPServer):
+    """ Stands in for the mail server, keeping what it is sent. """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.address = '127.0.0.1:%d' % self.socket.getsockname()[1]
+        self.messages = []
+
+    def process_message(self, peer, sender, recipients, data):
+        self.messages.append((sender, recipients, data))
+
+
+def unused_address():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % listener.getsockname()[1]
+    listener.close()
+    return address
+
+
+class MailerTest(unittest.TestCase):
+    def setUp(self):
+        tests.application()
+        Mail.query.delete()
+        models.session.commit()
+        self.server = Recorder()
+        self.loop = Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.loop.daemon = True
+        self.loop.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.join()
+        models.session.remove()
+
+    def queue(self, count):
+        for i in range(count):
+            Mail(sender=u'piki@example.com',
+                recipient=u'reader%d@example.com' % i,
+                message=u'Subject: Hello %d\n\nWelcome.' % i)
+        models.session.commit()
+
+    def test_sends_everything_due(self):
+        self.queue(3)
+        mailer = Mailer(server=self.server.address, password=None)
+        self.assertEqual(mailer.drain(), 3)
+        mailer.close()
+        self.assertEqual(sorted(recipients for sender, recipients, data
+            in self.server.messages), [['reader%d@example.com' % i]
+            for i in range(3)])
+        self.assertEqual(Mail.query.count(), 0)
+
+    def test_mailers_never_send_a_message_twice(self):
+        self.queue(30)
+        def drain():
+            mailer = Mailer(server=self.server.address, password=None)
+            try:
+                mailer.drain()
+            finally:
+                mailer.close()
+                models.session.remove()
+        threads = [Thread(target=drain) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recipients = [recipients[0] for sender, recipients, data
+            in self.server.messages]
+        self.assertEqual(len(recipients), 30)
+        self.assertEqual(len(set(recipients)), 30)
+        self.assertEqual(Mail.query.count(), 0)
+
+    def test_failed_messages_are_put_off(self):
+        self.queue(2)
+        mailer = Mailer(server=unused_address(), password=None,
+            retry_delay=60)
+        self.assertEqual(mailer.drain(), 0)
+        self.assertEqual(mailer.retries, 1)
+        failed = Mail.query.filter(Mail.attempts == 1).one()
+        self.assertTrue(failed.send_date > datetime.now())
+        self.assertEqual(mailer.stats()['queued'], 2)
+
+    def test_worker_survives_errors(self):
+        rounds = []
+        mailer = Mailer(server=self.server.address, password=None,
+            interval=0.01, teardown=models.session.remove)
+        def drain():
+            rounds.append(None)
+            if len(rounds) == 1:
+                raise RuntimeError("The database went away.")
+        mailer.drain = drain
+        mailer.start()
+        for i in range(100):
+            if len(rounds) > 2:
+                break
+            time.sleep(0.01)
+        alive = mailer.thread.is_alive()
+        mailer.stop()
+        self.assertTrue(len(rounds) > 2)
+        self.assertTrue(alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
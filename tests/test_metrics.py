@@ -0,0 +1,78 @@
+####################
+#  Metrics Tests   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine
+import tests
+import piki
+import models
+import metrics
+from metrics import Metrics
+
+
+class MonitoringAccessTest(unittest.TestCase):
+    def setUp(self):
+        self.client = tests.application().test_client()
+        self.local = models.local
+        models.local = False
+        self.admin_names = piki.admin_names
+        piki.admin_names = [u'Overseer']
+
+    def tearDown(self):
+        models.local = self.local
+        piki.admin_names = self.admin_names
+        models.session.remove()
+
+    def test_hidden_from_visitors_and_other_users(self):
+        self.assertEqual(self.client.get('/stats!').status_code, 404)
+        user, wiki = tests.make_wiki(u'Bystander', u'Bystanding', [])
+        tests.log_in(self.client, user)
+        self.assertEqual(self.client.get('/stats!').status_code, 404)
+        self.assertEqual(self.client.get('/profiles!').status_code, 404)
+
+    def test_shown_to_admins(self):
+        user, wiki = tests.make_wiki(u'Overseer', u'Overseeing', [])
+        tests.log_in(self.client, user)
+        self.assertEqual(self.client.get('/stats!').status_code, 200)
+        self.assertEqual(self.client.get('/profiles!').status_code, 200)
+
+
+class RequestTimingTest(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        @self.app.route('/fails')
+        def fails():
+            raise RuntimeError("Something broke.")
+        @self.app.route('/works')
+        def works():
+            return 'works'
+        self.metrics = Metrics(self.app, create_engine('sqlite://'),
+            profile_rate=1.0)
+        @self.app.after_request
+        def registered_later(response):
+            response.headers['X-Later'] = 'yes'
+            return response
+
+    def test_finish_runs_after_every_other_function(self):
+        self.assertEqual(self.app.after_request_funcs[None][0],
+            self.metrics.finish)
+        response = self.app.test_client().get('/works')
+        self.assertTrue('total;dur=' in response.headers['Server-Timing'])
+        self.assertEqual(len(self.metrics.recent_profiles()), 1)
+
+    def test_failed_request_stops_the_profiler(self):
+        response = self.app.test_client().get('/fails')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(metrics.state.profile, None)
+        self.assertEqual(metrics.current(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+####################
+# Migration Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import os
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.engine.reflection import Inspector
+import tests
+import migrate
+from models import Posting
+
+
+class PasswordLengthTest(unittest.TestCase):
+    def setUp(self):
+        tests.application()
+        self.path = os.path.join(tests.directory, 'narrow.sqlite')
+        self.engine = create_engine('sqlite:///%s' % self.path)
+        self.engine.execute("CREATE TABLE models_user (id INTEGER NOT "
+            "NULL, name VARCHAR(50), name_slug VARCHAR(50), password "
+            "VARCHAR(54), email VARCHAR(50), join_date DATETIME, verified "
+            "BOOLEAN, PRIMARY KEY (id))")
+        self.engine.execute("INSERT INTO models_user (id, name, password) "
+            "VALUES (7, 'Old', 'sha1$salt$digest')")
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def password_length(self):
+        columns = Inspector.from_engine(self.engine).get_columns(
+            'models_user')
+        return dict((column['name'], column['type'].length)
+            for column in columns if column['name'] == 'password')
+
+    def test_sqlite_table_is_left_alone(self):
+        # SQLite does not enforce the length, so longer hashes already fit.
+        migrate.password_length(self.engine)
+        self.assertEqual(self.password_length(), {'password': 54})
+        self.engine.execute("UPDATE models_user SET password = '%s'"
+            % ('x' * 128))
+        self.assertEqual(self.engine.execute("SELECT id, name, "
+            "length(password) FROM models_user").fetchall(), [(7, u'Old',
+            128)])
+
+
+class PostingIndexTest(unittest.TestCase):
+    def setUp(self):
+        tests.application()
+        self.path = os.path.join(tests.directory, 'postings.sqlite')
+        self.engine = create_engine('sqlite:///%s' % self.path)
+        self.engine.execute("CREATE TABLE models_posting (id INTEGER NOT "
+            "NULL, term VARCHAR(50), page_id INTEGER, wiki_id INTEGER, "
+            "count INTEGER, PRIMARY KEY (id))")
+        self.engine.execute("CREATE INDEX ix_models_posting_term_wiki_id "
+            "ON models_posting (term, wiki_id)")
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_covering_index_replaces_the_old_one(self):
+        expected = set(['ix_models_posting_term_wiki_id_page_id_count',
+            'ix_models_posting_page_id', 'ix_models_posting_wiki_id'])
+        migrate.posting_index(self.engine)
+        self.assertEqual(migrate.index_names(self.engine,
+            Posting.table), expected)
+        # Running it again changes nothing.
+        migrate.posting_index(self.engine)
+        self.assertEqual(migrate.index_names(self.engine,
+            Posting.table), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
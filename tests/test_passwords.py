@@ -0,0 +1,51 @@
+####################
+#  Password Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import time
+import unittest
+from passwords import Hasher, Saturated, hash_password, check_password
+
+
+class HasherTest(unittest.TestCase):
+    def setUp(self):
+        self.hasher = Hasher(workers=1, queue_limit=1, timeout=0.1)
+
+    def tearDown(self):
+        self.hasher.pool.terminate()
+
+    def test_round_trip(self):
+        pwhash = self.hasher.hash(u'correct horse')
+        self.assertTrue(self.hasher.check(pwhash, u'correct horse'))
+        self.assertFalse(self.hasher.check(pwhash, u'battery staple'))
+        self.assertTrue(check_password(hash_password(u'p', 10), u'p'))
+
+    def test_timed_out_job_keeps_its_slot(self):
+        self.assertRaises(Saturated, self.hasher.run, time.sleep, 0.5)
+        # The sleep is still running in the pool and holds the only slot.
+        self.assertRaises(Saturated, self.hasher.run, abs, -1)
+        time.sleep(0.6)
+        self.assertEqual(self.hasher.run(abs, -1), 1)
+
+    def test_errors_are_raised_and_free_the_slot(self):
+        self.assertRaises(ValueError, self.hasher.run, int, 'x')
+        self.assertEqual(self.hasher.run(int, '2'), 2)
+
+    def test_forked_process_starts_afresh(self):
+        pool, slots = self.hasher.start()
+        slots.acquire()
+        # As if this were a worker forked from the process that started it.
+        self.hasher.pid = None
+        new_pool, new_slots = self.hasher.start()
+        pool.terminate()
+        self.assertTrue(new_pool is not pool)
+        self.assertTrue(new_slots.acquire(False))
+
+
+if __name__ == '__main__':
+    unittest.main()
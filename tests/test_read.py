@@ -0,0 +1,34 @@
+####################
+#    Read Tests    #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import unittest
+import tests
+import models
+
+
+class CursorTest(unittest.TestCase):
+    def setUp(self):
+        self.client = tests.application().test_client()
+
+    def tearDown(self):
+        models.session.remove()
+
+    def test_malformed_cursor_reads_from_the_start(self):
+        for cursor in ['', 'x', '1', '1-2-3', '1-x', '1--1']:
+            response = self.client.get('/read?after=' + cursor)
+            self.assertEqual(response.status_code, 200, cursor)
+
+    def test_out_of_range_cursor_is_refused(self):
+        for cursor in ['9' * 30 + '-1', '1-' + '9' * 30]:
+            response = self.client.get('/read?after=' + cursor)
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
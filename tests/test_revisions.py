@@ -0,0 +1,38 @@
+####################
+# Revisions Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import unittest
+import tests
+import models
+from models import Page
+
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        models.session.remove()
+
+    def test_restored_title_is_escaped(self):
+        user, wiki = tests.make_wiki(u'Restorer', u'Restorable',
+            [u'<script>alert(1)</script>'])
+        page = Page.get_by(wiki=wiki, title=u'<script>alert(1)</script>')
+        page_id, revision = page.id, page.revisions.first()
+        tests.log_in(self.client, user)
+        response = self.client.post('/:%s/%s/%s/revisions!/%d' % (
+            user.name_slug, wiki.title_slug, page.title_slug, revision.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Page.get_by(id=page_id).blocks[0].html,
+            u'<h1>&lt;script&gt;alert(1)&lt;/script&gt;</h1>')
+
+
+if __name__ == '__main__':
+    unittest.main()
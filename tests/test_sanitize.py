@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+####################
+#  Sanitize Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import re
+import random
+import unittest
+from models import sanitize
+
+# The sanitizer that save! used before it looked behind instead of
+#   reversing the page, kept to check that the output has not changed.
+unsafe_lt = re.compile(r"<(?!/?(h1|h2|h3|p|b|i|u)>)")
+unsafe_gt = re.compile(r">(?!(1h|2h|3h|p|b|i|u)/?<)")
+
+def reference_sanitize(html):
+    html = re.sub(unsafe_lt, '&lt;', html)
+    return re.sub(unsafe_gt, ';tg&', html[::-1])[::-1]
+
+
+corpus = [
+    u'',
+    u'<p>plain text</p>',
+    u'<h1>Title</h1><h2>Sub</h2><h3>Subsub</h3><p>text</p>',
+    u'<p>1 < 2 > 0</p>',
+    u'<p><b>bold</b> <i>italic</i> <u>underlined</u></p>',
+    u'<p><script>alert(1)</script></p>',
+    u'<p><img src=x onerror=alert(1)></p>',
+    u'<p><a href="javascript:alert(1)">link</a></p>',
+    u'<h4>not allowed</h4><div>nor this</div>',
+    u'<P>upper case</P><B>bold</B>',
+    u'<p>< p>spaced</ p></p>',
+    u'<p><<b>>double<</b>></p>',
+    u'<p>>>>><<<<</p>',
+    u'<p>a<br>b<br/>c</p>',
+    u'<p><b><i><u>nested</u></i></b></p>',
+    u'<h1></h1>',
+    u'<p>&lt;already escaped&gt;</p>',
+    u'<p>unterminated <b',
+    u'b> <p <h1 h1> /p>',
+    u'<p>ünicøde ☃ <i>日本</i></p>',
+    u'<p>\n<b>\nline\n</b>\n</p>',
+    u'</h1></h2></h3></p></b></i></u>',
+    u'<h1><h1><h1>',
+    u'<hh1>h</hh1><pp>p</pp><bi>x</bi>',
+]
+
+# Pieces that random documents are made of, weighted towards tags and
+#   brackets where the two sanitizers could disagree.
+pieces = ['<', '>', '/', 'p', 'b', 'i', 'u', 'h', '1', '2', '3', '4', ' ',
+    'x', '<p>', '</p>', '<b>', '</b>', '<h1>', '</h1>', '<h3>', '</h2>',
+    '<i>', '</u>', '<br>', '&lt;', '\n']
+
+
+class SanitizeTest(unittest.TestCase):
+    def test_corpus(self):
+        for html in corpus:
+            self.assertEqual(sanitize(html), reference_sanitize(html), html)
+
+    def test_random_documents(self):
+        rng = random.Random(7)
+        for i in range(5000):
+            html = u''.join(rng.choice(pieces)
+                for j in range(rng.randrange(1, 40)))
+            self.assertEqual(sanitize(html), reference_sanitize(html), html)
+
+    def test_large_page(self):
+        html = u''.join(u'<p>%d < %d <b>bold</b> <script>x</script></p>'
+            % (i, i + 1) for i in range(20000))
+        self.assertEqual(sanitize(html), reference_sanitize(html))
+
+
+if __name__ == '__main__':
+    unittest.main()
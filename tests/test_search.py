@@ -0,0 +1,100 @@
+####################
+#   Search Tests   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import random
+import unittest
+from math import log
+import tests
+import models
+import search
+from models import Page, Posting
+
+
+def reference_scores(terms, wiki):
+    """ Scores pages in Python the way search did before it ranked in SQL.
+    <- dictionary of scores by page id
+    """
+    postings = Posting.query.filter(Posting.term.in_(terms)) \
+        .filter(Posting.wiki_id == wiki.id)
+    by_term = dict((term, {}) for term in terms)
+    for posting in postings:
+        by_term[posting.term][posting.page_id] = posting.count
+    if not all(by_term.values()):
+        return {}
+    total = Page.query.filter(Page.wiki_id == wiki.id).count()
+    matching = set.intersection(*(set(p) for p in by_term.values()))
+    scores = {}
+    for term, counts in by_term.iteritems():
+        idf = log(float(total) / len(counts)) + 1
+        for page_id in matching:
+            scores[page_id] = scores.get(page_id, 0) + \
+                (1 + log(counts[page_id])) * idf
+    return scores
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        tests.application()
+
+    def tearDown(self):
+        models.session.remove()
+
+    def test_ranking_matches_scoring_in_python(self):
+        rng = random.Random(0)
+        vocabulary = ['river', 'piano', 'garden', 'letter', 'engine']
+        user, wiki = tests.make_wiki(u'Searcher', u'Ranked',
+            [u'Page %d' % i for i in range(40)])
+        for page in Page.query.filter_by(wiki=wiki):
+            page.content = u'<h1>%s</h1><p>%s</p>' % (page.title, u' '.join(
+                rng.choice(vocabulary[:rng.randint(1, 5)])
+                for i in range(rng.randint(1, 30))))
+            search.index_page(page)
+        models.session.commit()
+        for query in ['river', 'piano garden', 'engine letter river',
+                'river river', 'absent', 'river absent']:
+            terms = sorted(set(search.tokenize(query)))
+            expected = reference_scores(terms, wiki)
+            results = search.search(query, wiki=wiki, limit=100)
+            scores = [expected[page.id] for page, snippet in results]
+            self.assertEqual(set(page.id for page, snippet in results),
+                set(expected))
+            for better, worse in zip(scores, scores[1:]):
+                self.assertTrue(better >= worse - 1e-9)
+            limited = search.search(query, wiki=wiki, limit=3)
+            self.assertEqual([page.id for page, snippet in limited],
+                [page.id for page, snippet in results[:3]])
+        # Published wikis are searched together.
+        everywhere = [page.id for page, snippet in search.search('piano',
+            limit=100)]
+        self.assertTrue(set(reference_scores(['piano'], wiki)) <=
+            set(everywhere))
+
+    def test_only_changed_postings_are_written(self):
+        user, wiki = tests.make_wiki(u'Searcher', u'Reindexed', [])
+        page = Page.get_by(wiki=wiki, title=u'Reindexed')
+        page.content = u'<h1>Reindexed</h1><p>kept kept changed gone</p>'
+        search.index_page(page)
+        models.session.commit()
+        before = dict((posting.term, posting.id) for posting in
+            Posting.query.filter_by(page_id=page.id))
+        page.content = u'<h1>Reindexed</h1><p>kept kept changed changed ' \
+            u'added</p>'
+        search.index_page(page)
+        models.session.commit()
+        after = dict((posting.term, (posting.id, posting.count))
+            for posting in Posting.query.filter_by(page_id=page.id))
+        self.assertEqual(dict((term, count) for term, (posting_id, count)
+            in after.iteritems()), search.term_counts(page.content))
+        self.assertEqual(after['kept'][0], before['kept'])
+        self.assertEqual(after['changed'][0], before['changed'])
+        self.assertNotIn('gone', after)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+####################
+#  Storage  Tests  #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import zlib
+import base64
+import unittest
+import tests
+import piki
+import models
+from models import Page, compress_text, decompress_text, \
+    compression_threshold
+
+forged = u'zlib:' + base64.b64encode(zlib.compress(
+    '<script>alert(1)</script>'))
+
+
+class CompressionTest(unittest.TestCase):
+    def test_text_reads_back_as_it_was_stored(self):
+        long_text = u'<p>%s</p>' % (u'pi\xf1ata ' * compression_threshold)
+        for text in [None, u'', u'<p>short</p>', long_text, forged,
+                forged * 100, u'raw:', u'raw:raw:zlib:', u'zlib:!',
+                u'zlib:' + long_text]:
+            self.assertEqual(decompress_text(compress_text(text)), text)
+        self.assertTrue(compress_text(long_text).startswith(u'zlib:'))
+
+    def test_malformed_compressed_text_reads_as_written(self):
+        for stored in [u'zlib:', u'zlib:not base64!', u'zlib:\xf1',
+                u'zlib:' + base64.b64encode('not zlib')]:
+            self.assertEqual(decompress_text(stored), stored)
+
+
+class StoredBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+
+    def tearDown(self):
+        piki.autosaves.flush_all()
+        models.session.remove()
+
+    def test_tagged_blocks_are_shown_as_text(self):
+        user, wiki = tests.make_wiki(u'Forger', u'Forged', [u'Target'])
+        url = '/:%s/%s/target' % (user.name_slug, wiki.title_slug)
+        page_id = Page.get_by(wiki=wiki, title=u'Target').id
+        client = self.app.test_client()
+        tests.log_in(client, user)
+        response = client.post(url + '/save!', data={'patch':
+            ['undefined', forged, u'zlib:!!!']})
+        self.assertEqual(response.status_code, 200)
+        piki.autosaves.flush(page_id)
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('alert(1)', response.data)
+        self.assertIn(forged.encode('utf-8'), response.data)
+        models.session.remove()
+        self.assertEqual([block.html for block in
+            Page.get_by(id=page_id).blocks][1:], [forged, u'zlib:!!!'])
+
+
+if __name__ == '__main__':
+    unittest.main()
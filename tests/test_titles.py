@@ -0,0 +1,69 @@
+####################
+#   Title  Tests   #
+#  Copyright 2012  #
+#  Artur  Ostrega  #
+# ---------------- #
+#  Released Under  #
+#   MIT  License   #
+####################
+
+import unittest
+import tests
+import piki
+import models
+from models import Wiki, Page
+
+
+class RetitleTest(unittest.TestCase):
+    def setUp(self):
+        self.app = tests.application()
+
+    def tearDown(self):
+        piki.autosaves.flush_all()
+        models.session.remove()
+
+    def make_wiki(self, title, page_titles):
+        user, wiki = tests.make_wiki(u'Titler', title, page_titles)
+        self.prefix = '/:%s/%s/' % (user.name_slug, wiki.title_slug)
+        self.wiki_id = wiki.id
+        self.client = self.app.test_client()
+        tests.log_in(self.client, user)
+
+    def retitle(self, page_slug, title):
+        return self.client.post(self.prefix + page_slug + '/save!',
+            data={'patch': ['<h1>%s</h1>' % title]})
+
+    def titles(self):
+        models.session.remove()
+        return [page.title for page in
+            Wiki.get_by(id=self.wiki_id).ordered_pages()]
+
+    def test_retitling_the_main_page_makes_a_new_one(self):
+        self.make_wiki(u'Retitled', [u'Second'])
+        response = self.retitle('retitled', u'Former main')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'former-main')
+        self.assertEqual(self.titles(), [u'Retitled', u'Former main',
+            u'Second'])
+        wiki = Wiki.get_by(id=self.wiki_id)
+        self.assertEqual(wiki.recount(), (3, wiki.last_page_id))
+
+    def test_taken_titles_are_numbered(self):
+        self.make_wiki(u'Taken', [u'X', u'X (alternative)', u'Y'])
+        response = self.retitle('y', u'X')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(), [u'Taken', u'X (alternative 2)',
+            u'X (alternative)', u'X'])
+        page = Page.get_by(wiki_id=self.wiki_id, title=u'X (alternative 2)')
+        self.assertTrue(page.content.startswith(u'<h1>X (alternative 2)'))
+
+    def test_renaming_a_wiki_to_one_of_its_pages(self):
+        self.make_wiki(u'Renamed', [u'Notes'])
+        response = self.client.post(self.prefix + 'settings!', data={
+            'title': u'Notes', 'publicity': 'public', 'autosave': 'on'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(), [u'Notes', u'Notes (alternative)'])
+
+
+if __name__ == '__main__':
+    unittest.main()